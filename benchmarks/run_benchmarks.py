@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Copyright 2017-2023 Jussi Pakkanen et al
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Times the generation hot path on synthetic staging trees. Runs on any
+# OS and does not need WiX.
+
+# The repository root has a test directory called msvcrt, which shadows
+# the Windows-only module of the same name that subprocess probes for.
+# Import it before the root is put on the path.
+import subprocess
+import os, sys, json, time, shutil, argparse, tempfile, platform, tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import createmsi
+
+# (files per directory, subdirectories per directory)
+SHAPES = {'wide': (1000, 50),
+          'deep': (10, 2),
+          }
+
+class NullFile:
+    def write(self, data):
+        pass
+
+def make_tree(root, num_files, shape, file_size):
+    files_per_dir, dirs_per_dir = SHAPES[shape]
+    payload = b'x' * file_size
+    queue = [root]
+    created = 0
+    num_dirs = 0
+    while created < num_files:
+        d = queue.pop(0)
+        os.makedirs(d, exist_ok=True)
+        num_dirs += 1
+        for i in range(min(files_per_dir, num_files - created)):
+            with open(os.path.join(d, 'file%d.dat' % i), 'wb') as f:
+                f.write(payload)
+            created += 1
+        for i in range(dirs_per_dir):
+            queue.append(os.path.join(d, 'dir%d' % i))
+    return num_dirs
+
+def backdate(root, seconds):
+    # The tree index does not trust directories modified right before a
+    # scan, so make the tree look like it was staged a while ago.
+    t = time.time() - seconds
+    for dirpath, _, filenames in os.walk(root):
+        for f in filenames:
+            os.utime(os.path.join(dirpath, f), (t, t))
+        os.utime(dirpath, (t, t))
+
+def make_definition(num_parts):
+    return {
+        'upgrade_guid': '2306069D-456E-4CA5-AA18-94805C18C5DF',
+        'version': '1.0.0',
+        'product_name': 'Benchmark',
+        'manufacturer': 'Benchmark',
+        'name': 'Benchmark',
+        'name_base': 'benchmark',
+        'comments': 'Synthetic benchmark package',
+        'installdir': 'Benchmark',
+        'parts': [{'id': 'Part%d' % i,
+                   'title': 'Part %d' % i,
+                   'description': 'Part %d' % i,
+                   'staged_dir': 'part%d' % i,
+                   } for i in range(num_parts)],
+    }
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def run_case(workdir, num_files, shape, num_parts, file_size, repeat, backends=()):
+    casedir = os.path.join(workdir, '%s-%d-%d' % (shape, num_files, num_parts))
+    num_dirs = 0
+    for i in range(num_parts):
+        num_dirs += make_tree(os.path.join(casedir, 'part%d' % i), num_files // num_parts, shape, file_size)
+    backdate(casedir, 3600)
+    definition = make_definition(num_parts)
+    timings = {}
+    def record(name, value):
+        timings[name] = min(timings.get(name, value), value)
+    p = createmsi.PackageGenerator(definition, basedir=casedir, tree_index=True)
+    p.scan()
+    p.save_index()
+    for _ in range(repeat):
+        p = createmsi.PackageGenerator(definition, basedir=casedir)
+        record('scan', timed(p.scan))
+        # What watch mode does after a file has changed in one directory.
+        record('update_tree', timed(lambda: createmsi.update_tree(p.trees['part0'], 'part0', ['part0'], casedir)))
+        p_indexed = createmsi.PackageGenerator(definition, basedir=casedir, tree_index=True)
+        record('scan_indexed', timed(p_indexed.scan))
+        p_verified = createmsi.PackageGenerator(definition, basedir=casedir, tree_index=True, verify_index=True)
+        record('scan_verified', timed(p_verified.scan))
+        # Write to a sink that throws everything away so that only the
+        # generation itself is measured.
+        p.start_document(NullFile())
+        p.plan_media()
+        record('create_xml', timed(lambda: [p.scan_feature(f) for f in p.parts]))
+        record('build_features', timed(lambda: [p.build_features(f['staged_dir']) for f in p.parts]))
+        record('write_wxs', timed(p.generate_files))
+        for name in backends:
+            # The whole package build with each backend from the same files.
+            b = createmsi.PackageGenerator(definition, basedir=casedir, backend=name)
+            b.generate_files()
+            record('build_' + name, timed(b.build_package))
+    tracemalloc.start()
+    p = createmsi.PackageGenerator(definition, basedir=casedir)
+    p.generate_files()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'name': '%s-%d-files-%d-parts' % (shape, num_files, num_parts),
+            'shape': shape,
+            'files': num_files,
+            'dirs': num_dirs,
+            'parts': num_parts,
+            'wxs_bytes': os.path.getsize(p.main_xml),
+            'timings': timings,
+            'peak_memory': peak,
+            }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_results, new_results):
+    old_cases = {c['name']: c for c in old_results['cases']}
+    print('\n%-32s %-16s %10s %10s %8s' % ('Case', 'Phase', 'Old', 'New', 'Change'))
+    for case in new_results['cases']:
+        old = old_cases.get(case['name'])
+        if old is None:
+            continue
+        rows = [(k, old['timings'].get(k), v) for k, v in case['timings'].items()]
+        rows.append(('peak_memory', old['peak_memory'], case['peak_memory']))
+        for phase, oldval, newval in rows:
+            if not oldval:
+                continue
+            print('%-32s %-16s %10.4g %10.4g %+7.1f%%' % (case['name'], phase, oldval, newval, 100.0 * (newval - oldval) / oldval))
+
+def int_list(value):
+    return [int(x) for x in value.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark WXS generation on synthetic staging trees.')
+    parser.add_argument('--files', type=int_list, default=[1000, 10000],
+                        help='comma separated list of total file counts (default: 1000,10000)')
+    parser.add_argument('--shapes', default='wide,deep',
+                        help='comma separated list of tree shapes: %s (default: %%(default)s)' % ', '.join(SHAPES))
+    parser.add_argument('--parts', type=int_list, default=[1, 4],
+                        help='comma separated list of part counts (default: 1,4)')
+    parser.add_argument('--file-size', type=int, default=0,
+                        help='size of each generated file in bytes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs per case, the fastest is reported (default: %(default)s)')
+    parser.add_argument('--workdir', default=None,
+                        help='where to create the synthetic trees (default: a temporary directory)')
+    parser.add_argument('--backends', default='',
+                        help='comma separated list of backends to time full builds with: %s (default: none)' % ', '.join(sorted(createmsi.BACKENDS)))
+    parser.add_argument('--compare', metavar='JSON',
+                        help='earlier results to compare against')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='file to write the results to (default: %(default)s)')
+    options = parser.parse_args()
+    backends = []
+    for name in filter(None, options.backends.split(',')):
+        backend = createmsi.BACKENDS[name]()
+        if shutil.which(backend.tool) is None:
+            print('Skipping the %s backend, %s is not installed.' % (name, backend.tool))
+        else:
+            backends.append(name)
+    workdir = tempfile.mkdtemp(prefix='msibench', dir=options.workdir)
+    results = {'revision': git_revision(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cases': [],
+               }
+    try:
+        for shape in options.shapes.split(','):
+            for num_files in options.files:
+                for num_parts in options.parts:
+                    case = run_case(workdir, num_files, shape, num_parts, options.file_size, options.repeat, backends)
+                    print('%-32s %s peak %.1f MB' % (case['name'],
+                          ' '.join('%s %.3fs' % t for t in case['timings'].items()),
+                          case['peak_memory'] / (1024 * 1024)))
+                    results['cases'].append(case)
+    finally:
+        shutil.rmtree(workdir)
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
@@ -14,32 +14,1167 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys, os, subprocess, shutil, uuid, json, re
-from glob import glob
+import sys, os, io, subprocess, shutil, uuid, json, re, hashlib, argparse, time, sqlite3, mmap, select, struct, errno
+import ctypes, ctypes.util
+from glob import glob, escape as glob_escape
+from collections import namedtuple
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import platform
 import xml.etree.ElementTree as ET
 
-sys.path.append(os.getcwd())
-
 def gen_guid():
     return str(uuid.uuid4()).upper()
 
+FileInfo = namedtuple('FileInfo', ['size', 'mtime_ns'])
+ChangeSet = namedtuple('ChangeSet', ['added', 'removed', 'modified'])
+
+# Files that carry a version resource and thus make good key paths.
+VERSIONED_EXTENSIONS = ('.exe', '.dll', '.sys', '.ocx', '.drv', '.cpl', '.scr')
+
 class Node:
-    def __init__(self, dirs, files):
+    def __init__(self, dirs, files, file_info=None, mtime_ns=None, excluded=None, sources=None):
         assert(isinstance(dirs, list))
         assert(isinstance(files, list))
         self.dirs = dirs
         self.files = files
+        self.file_info = file_info if file_info is not None else {}
+        self.mtime_ns = mtime_ns
+        # Maps the reason an entry was left out to [files, bytes, dirs].
+        self.excluded = excluded if excluded is not None else {}
+        # Files that are not in the directory the node stands for, such
+        # as those of install manifests, map to where they really are.
+        self.sources = sources if sources is not None else {}
+
+def glob_to_regex(pattern):
+    # As in .gitignore, a pattern without a slash matches a name at any
+    # depth and other patterns, including those that start with a slash,
+    # are matched against the whole path. A ** matches any number of
+    # directories. A trailing slash is left to the caller, see PathFilter.
+    pattern = pattern.replace('\\', '/').rstrip('/')
+    out = [] if '/' in pattern else ['(?:.*/)?']
+    pattern = pattern.lstrip('/')
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i+1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            out.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(out)
+
+def dir_pattern(pattern):
+    # As in .gitignore, a pattern ending in a slash only matches directories.
+    return pattern.replace('\\', '/').endswith('/')
+
+class PathFilter:
+    # The include and exclude globs of a part. Each list is compiled
+    # into a single regular expression. Excludes apply to files and
+    # directories, includes only to files.
+    def __init__(self, root, include=None, exclude=None):
+        self.root = root
+        self.include = include if include is not None else []
+        self.exclude = exclude if exclude is not None else []
+        # File names are case insensitive on Windows.
+        self.flags = re.IGNORECASE if platform.system() == "Windows" else 0
+        self.include_re = self.compile(self.include)
+        self.dir_exclude_re = self.compile(self.exclude)
+        self.file_exclude_re = self.compile([p for p in self.exclude if not dir_pattern(p)])
+        self.exclude_res = [(p, self.compile([p])) for p in self.exclude]
+
+    def compile(self, patterns):
+        if not patterns:
+            return None
+        return re.compile('(?:%s)\\Z' % '|'.join(glob_to_regex(p) for p in patterns), self.flags)
+
+    def signature(self):
+        return json.dumps([self.include, self.exclude])
+
+    def exclusion(self, path, is_dir):
+        # Returns why the path is left out or None if it is not.
+        relpath = path[len(self.root) + 1:].replace('\\', '/')
+        exclude_re = self.dir_exclude_re if is_dir else self.file_exclude_re
+        if exclude_re is not None and exclude_re.match(relpath):
+            # Only excluded entries get matched against every pattern.
+            for p, regex in self.exclude_res:
+                if (is_dir or not dir_pattern(p)) and regex.match(relpath):
+                    return p
+        if not is_dir and self.include_re is not None and not self.include_re.match(relpath):
+            return 'not included'
+        return None
+
+def scan_directory(path, basedir='', previous=None, path_filter=None, verify=False):
+    fullpath = os.path.join(basedir, path)
+    # Taken before listing, so that a change made during the listing
+    # shows up as a modified directory on the next scan.
+    mtime_ns = os.stat(fullpath).st_mtime_ns
+    if previous is not None and previous.mtime_ns == mtime_ns and not verify:
+        # The entries of an unmodified directory are the same as last
+        # time. Files rewritten in place do not touch it, though.
+        return Node(list(previous.dirs), list(previous.files), dict(previous.file_info), mtime_ns, previous.excluded)
+    # On Windows the listing contains sizes and mtimes, which makes it
+    # cheaper than stat'ing the files one by one.
+    if previous is not None and previous.mtime_ns == mtime_ns and platform.system() != "Windows":
+        try:
+            file_info = {}
+            for f in previous.files:
+                st = os.stat(os.path.join(fullpath, f))
+                file_info[f] = FileInfo(st.st_size, st.st_mtime_ns)
+            return Node(list(previous.dirs), list(previous.files), file_info, mtime_ns, previous.excluded)
+        except FileNotFoundError:
+            pass
+    dirs = []
+    files = []
+    file_info = {}
+    excluded = {}
+    with os.scandir(fullpath) as it:
+        for entry in it:
+            if path_filter is not None:
+                is_dir = entry.is_dir()
+                reason = path_filter.exclusion(os.path.join(path, entry.name), is_dir)
+                if reason is not None:
+                    counts = excluded.setdefault(reason, [0, 0, 0])
+                    if is_dir:
+                        # Pruned, so the size of its contents is not known.
+                        counts[2] += 1
+                    else:
+                        counts[0] += 1
+                        counts[1] += entry.stat().st_size
+                    continue
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                st = entry.stat()
+                files.append(entry.name)
+                file_info[entry.name] = FileInfo(st.st_size, st.st_mtime_ns)
+    # Listing order depends on the file system, sort so that the output
+    # is the same everywhere.
+    dirs.sort()
+    files.sort()
+    return Node(dirs, files, file_info, mtime_ns, excluded)
+
+def scan_trees(roots, max_workers=None, basedir='', previous=None, filters=None, verify=False):
+    # Every directory listing is a separate task, so subdirectories and
+    # separate trees are all listed concurrently. Each tree is returned
+    # as a dict mapping directory paths, relative to basedir, to Nodes.
+    # Listings of unmodified directories are taken from previous, which
+    # has the same structure, if given. With verify the files in them
+    # are checked for changes as well. Filters maps roots to PathFilters.
+    if previous is None:
+        previous = {}
+    if filters is None:
+        filters = {}
+    trees = {}
+    with ThreadPoolExecutor(max_workers) as pool:
+        pending = {}
+        for root in roots:
+            trees[root] = {}
+            old_nodes = previous.get(root, {})
+            pending[pool.submit(scan_directory, root, basedir, old_nodes.get(root), filters.get(root), verify)] = (root, root)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                root, path = pending.pop(fut)
+                node = fut.result()
+                trees[root][path] = node
+                old_nodes = previous.get(root, {})
+                for d in node.dirs:
+                    subdir = os.path.join(path, d)
+                    pending[pool.submit(scan_directory, subdir, basedir, old_nodes.get(subdir), filters.get(root), verify)] = (root, subdir)
+    return trees
+
+def tree_changes(old_nodes, new_nodes):
+    # Files are compared by size and modification time.
+    added = []
+    removed = []
+    modified = []
+    for dirpath, node in new_nodes.items():
+        old = old_nodes.get(dirpath)
+        if old is None:
+            added += [os.path.join(dirpath, f) for f in node.files]
+            continue
+        if old.files == node.files and old.file_info == node.file_info:
+            continue
+        for f in node.files:
+            if f not in old.file_info:
+                added.append(os.path.join(dirpath, f))
+            elif old.file_info[f] != node.file_info.get(f):
+                modified.append(os.path.join(dirpath, f))
+        removed += [os.path.join(dirpath, f) for f in old.files if f not in node.file_info]
+    for dirpath, old in old_nodes.items():
+        if dirpath not in new_nodes:
+            removed += [os.path.join(dirpath, f) for f in old.files]
+    return ChangeSet(sorted(added), sorted(removed), sorted(modified))
+
+def update_tree(nodes, root, changed, basedir='', path_filter=None):
+    # Returns a copy of the tree of root with the directories in changed
+    # listed again. Directories that have appeared are scanned as a whole
+    # and those that have gone away are dropped with their contents.
+    nodes = dict(nodes)
+    # Parents first, so that the children of removed directories are
+    # already gone when they come up.
+    for path in sorted(changed, key=len):
+        old = nodes.get(path)
+        if old is None:
+            continue
+        try:
+            node = scan_directory(path, basedir, None, path_filter)
+        except (FileNotFoundError, NotADirectoryError):
+            # The parent is in changed as well and takes care of it.
+            continue
+        nodes[path] = node
+        for d in old.dirs:
+            if d not in node.dirs:
+                subdir = os.path.join(path, d)
+                for p in [p for p in nodes if p == subdir or p.startswith(subdir + os.sep)]:
+                    del nodes[p]
+        new_dirs = [os.path.join(path, d) for d in node.dirs if d not in old.dirs]
+        if new_dirs:
+            filters = {d: path_filter for d in new_dirs} if path_filter is not None else None
+            for subtree in scan_trees(new_dirs, basedir=basedir, filters=filters).values():
+                nodes.update(subtree)
+    return nodes
+
+def tree_from_paths(root, entries):
+    # Builds the same structure as scan_trees does for one tree from an
+    # iterable of (path relative to root, FileInfo or None) pairs.
+    nodes = {root: Node([], [])}
+    for relpath, info in entries:
+        segments = relpath.replace('\\', '/').strip('/').split('/')
+        cur_dir = root
+        for d in segments[:-1]:
+            subdir = os.path.join(cur_dir, d)
+            if subdir not in nodes:
+                nodes[subdir] = Node([], [])
+                nodes[cur_dir].dirs.append(d)
+            cur_dir = subdir
+        fname = segments[-1]
+        nodes[cur_dir].files.append(fname)
+        if info is not None:
+            nodes[cur_dir].file_info[fname] = info
+    for node in nodes.values():
+        node.dirs.sort()
+        node.files.sort()
+    return nodes
+
+def read_install_manifest(fname, prefix=None, basedir=''):
+    # Returns (source, destination) pairs from an install manifest, with
+    # destinations relative to the installation directory. JSON files
+    # have an object mapping sources to destinations, like Meson's
+    # intro-installed.json, or a list of pairs. Text files have a line per
+    # file, either "source -> destination" or, like CMake's
+    # install_manifest.txt, just the installed file.
+    with open(os.path.join(basedir, fname), encoding='utf-8') as f:
+        if fname.endswith('.json'):
+            data = json.load(f)
+            pairs = list(data.items()) if isinstance(data, dict) else [tuple(p) for p in data]
+        else:
+            pairs = []
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if ' -> ' in line:
+                    pairs.append(tuple(x.strip() for x in line.split(' -> ', 1)))
+                else:
+                    pairs.append((line, line))
+    if prefix is not None:
+        prefix = prefix.replace('\\', '/').rstrip('/') + '/'
+    result = []
+    errors = []
+    for source, dest in pairs:
+        dest = dest.replace('\\', '/')
+        if prefix is not None:
+            if not dest.startswith(prefix):
+                errors.append('%s is not in install_prefix %s.' % (dest, prefix))
+                continue
+            dest = dest[len(prefix):]
+        elif os.path.isabs(dest) or re.match('[A-Za-z]:/', dest):
+            errors.append('%s is an absolute path, set install_prefix to make it relative.' % dest)
+            continue
+        if '..' in dest.split('/'):
+            errors.append('%s is outside of the installation directory.' % dest)
+            continue
+        result.append((source, dest.strip('/')))
+    if errors:
+        sys.exit(format_errors('Install manifest %s' % fname, errors[:10]))
+    return result
+
+def tree_from_manifest(root, pairs, basedir='', max_workers=None):
+    # Builds a tree of the destinations in pairs from read_install_manifest
+    # with the sizes and mtimes of the sources, without copying anything.
+    def stat(pair):
+        try:
+            st = os.stat(os.path.join(basedir, pair[0]))
+            return FileInfo(st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+    with ThreadPoolExecutor(max_workers) as pool:
+        infos = list(pool.map(stat, pairs))
+    missing = ['%s does not exist.' % source for (source, _), info in zip(pairs, infos) if info is None]
+    if missing:
+        sys.exit(format_errors('Install manifest %s' % root, missing[:10]))
+    nodes = tree_from_paths(root, ((dest, info) for (_, dest), info in zip(pairs, infos)))
+    for source, dest in pairs:
+        dirpath, fname = os.path.split(os.path.join(root, *dest.split('/')))
+        if fname in nodes[dirpath].sources:
+            sys.exit('Install manifest %s has %s more than once.' % (root, dest))
+        nodes[dirpath].sources[fname] = source
+    return nodes
+
+def walk_tree(nodes, current_dir):
+    # Same order in which create_xml writes the tree out.
+    yield current_dir, nodes[current_dir]
+    for d in nodes[current_dir].dirs:
+        yield from walk_tree(nodes, os.path.join(current_dir, d))
+
+def hash_file(path):
+    # Large files are mapped into memory and hashed with a single call,
+    # the rest are read into a reused buffer. hashlib does not hold the
+    # GIL while hashing, so this can be run in threads.
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= 64*1024*1024:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+            return h.hexdigest()
+        buf = bytearray(1024*1024)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+class Fingerprint:
+    # A hash of a sequence of values, used for all the fingerprints so
+    # that they encode values the same way. Every value is terminated, so
+    # that ('ab', 'c') and ('a', 'bc') differ.
+    def __init__(self):
+        self.h = hashlib.sha256()
+
+    def add(self, *items):
+        for i in items:
+            self.h.update(str(i).encode('utf-8'))
+            self.h.update(b'\0')
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+class WxsWriter:
+    # Writes an XML document incrementally with the same layout as
+    # minidom's toprettyxml(indent=' '). Only the chain of currently
+    # open elements is kept in memory.
+    def __init__(self, ofile, indent=' '):
+        self.ofile = ofile
+        self.indent = indent
+        self.open_elements = []
+        self.start_tag_open = False
+        self.ofile.write('<?xml version="1.0" ?>\n')
+
+    @staticmethod
+    def escape(data):
+        return data.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+    def close_start_tag(self):
+        if self.start_tag_open:
+            self.ofile.write('>\n')
+            self.start_tag_open = False
+
+    def start(self, tag, attrs=None):
+        self.close_start_tag()
+        self.ofile.write(self.indent * len(self.open_elements) + '<' + tag)
+        if attrs:
+            for key, value in attrs.items():
+                self.ofile.write(' %s="%s"' % (key, self.escape(value)))
+        self.open_elements.append(tag)
+        self.start_tag_open = True
+
+    def end(self):
+        tag = self.open_elements.pop()
+        if self.start_tag_open:
+            self.ofile.write('/>\n')
+            self.start_tag_open = False
+        else:
+            self.ofile.write(self.indent * len(self.open_elements) + '</%s>\n' % tag)
+
+    def element(self, tag, attrs=None, text=None):
+        self.start(tag, attrs)
+        if text:
+            self.ofile.write('>' + self.escape(text))
+            self.start_tag_open = False
+            self.open_elements.pop()
+            self.ofile.write('</%s>\n' % tag)
+        else:
+            self.end()
+
+    def write_tree(self, element):
+        if len(element) == 0:
+            self.element(element.tag, element.attrib, element.text)
+            return
+        self.start(element.tag, element.attrib)
+        for child in element:
+            self.write_tree(child)
+        self.end()
+
+    def close(self):
+        assert(not self.open_elements)
+
+def cache_dir():
+    if 'MSICREATOR_CACHE_DIR' in os.environ:
+        return os.environ['MSICREATOR_CACHE_DIR']
+    if platform.system() == "Windows" and 'LOCALAPPDATA' in os.environ:
+        return os.path.join(os.environ['LOCALAPPDATA'], 'msicreator')
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'msicreator')
+
+def redist_glob(arch):
+    if arch == 64:
+        if platform.system() == "Windows":
+            return 'C:\\Program Files\\Microsoft Visual Studio\\*\\*\\VC\\Redist\\MSVC\\v*\\MergeModules\\Microsoft_VC*_CRT_x64.msm'
+        return '/usr/share/msicreator/Microsoft_VC141_CRT_x64.msm'
+    if platform.system() == "Windows":
+        return 'C:\\Program Files\\Microsoft Visual Studio\\*\\Community\\VC\\Redist\\MSVC\\*\\MergeModules\\Microsoft_VC*_CRT_x86.msm'
+    return '/usr/share/msicreator/Microsoft_VC141_CRT_x86.msm'
+
+def find_redist(arch):
+    # Globbing through every Visual Studio installation is slow, so the
+    # result is remembered per arch until the file disappears.
+    cache_file = os.path.join(cache_dir(), 'redist.json')
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cached = cache.get(str(arch))
+    if cached is not None and os.path.isfile(cached):
+        return cached
+    trials = glob(redist_glob(arch))
+    if len(trials) > 1:
+        sys.exit('There are more than one redist dirs: ' + 
+                 ', '.join(trials))
+    if len(trials) == 0:
+        sys.exit('No redist dirs were detected, install MSM redistributables with VS installer.')
+    cache[str(arch)] = trials[0]
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Several builds may be running at the same time.
+        tmpfile = '%s.%d' % (cache_file, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpfile, cache_file)
+    except OSError:
+        pass
+    return trials[0]
+
+def peak_memory():
+    # Peak resident set size of this process in bytes, or None if it can
+    # not be determined.
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes everywhere else.
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    if sys.platform == 'win32':
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t),
+                        ]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        ctypes.windll.psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE,
+                                                             ctypes.POINTER(PROCESS_MEMORY_COUNTERS),
+                                                             wintypes.DWORD]
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                    ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+class BuildReport:
+    # Collects timings and sizes of a package build. Phases may nest, e.g.
+    # the scan is usually part of the fingerprint phase. Every phase is
+    # timed always, the report is only written out if enabled. Hooks are
+    # called with it either way.
+    def __init__(self, enabled=False, hooks=None):
+        self.enabled = enabled
+        self.hooks = hooks if hooks is not None else []
+        self.phases = {}
+        self.parts = {}
+        self.values = {}
+
+    @contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        times = os.times()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0})
+            entry['wall'] += time.perf_counter() - wall
+            entry['cpu'] += time.process_time() - cpu
+            end_times = os.times()
+            entry['child_cpu'] += (end_times.children_user - times.children_user) + \
+                (end_times.children_system - times.children_system)
+
+    def add_part(self, part_id, nodes, num_components):
+        files = 0
+        size = 0
+        excluded = {}
+        for node in nodes.values():
+            files += len(node.files)
+            size += sum(info.size for info in node.file_info.values() if info.size is not None)
+            for reason, counts in node.excluded.items():
+                total = excluded.setdefault(reason, {'files': 0, 'bytes': 0, 'dirs': 0})
+                total['files'] += counts[0]
+                total['bytes'] += counts[1]
+                total['dirs'] += counts[2]
+        self.parts[part_id] = {'files': files,
+                               'dirs': len(nodes),
+                               'components': num_components,
+                               'bytes': size,
+                               'excluded': excluded,
+                               }
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def finish(self):
+        result = dict(self.values)
+        result['phases'] = self.phases
+        result['parts'] = self.parts
+        result['peak_memory'] = peak_memory()
+        for hook in self.hooks:
+            hook(result)
+        return result
+
+class CabinetCache:
+    # Cabinets are named after a hash of their contents, so a cabinet with
+    # the right name in the cache can be reused by WiX as is. The least
+    # recently used ones are deleted when the cache grows over max_size.
+    def __init__(self, cachedir, max_size):
+        self.cachedir = os.path.abspath(cachedir)
+        self.max_size = max_size
+        self.hits = []
+        self.misses = []
+        self.evicted = []
+
+    def prepare(self, cabinets):
+        os.makedirs(self.cachedir, exist_ok=True)
+        for c in cabinets:
+            if os.path.exists(os.path.join(self.cachedir, c)):
+                self.hits.append(c)
+            else:
+                self.misses.append(c)
+
+    def update(self, cabinets):
+        now = time.time()
+        for c in cabinets:
+            cabfile = os.path.join(self.cachedir, c)
+            if os.path.exists(cabfile):
+                os.utime(cabfile, (now, now))
+        total = 0
+        candidates = []
+        with os.scandir(self.cachedir) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.endswith('.cab'):
+                    continue
+                st = entry.stat()
+                total += st.st_size
+                if entry.name not in cabinets:
+                    candidates.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(candidates):
+            if total <= self.max_size:
+                break
+            os.unlink(os.path.join(self.cachedir, name))
+            total -= size
+            self.evicted.append(name)
+
+    def report(self):
+        print('Cabinet cache: %d hits, %d misses, %d evicted.' % (len(self.hits), len(self.misses), len(self.evicted)))
+
+class TreeIndex:
+    # Stores the scanned staged trees and file hashes between runs in an
+    # SQLite database. A directory listing is only reused if the mtime
+    # of the directory is unchanged. Mtimes that are very close to the
+    # time of the scan are not stored, since a later change might not
+    # change the mtime on file systems with a coarse timestamp resolution.
+    # The same goes for directories with such files, which might still
+    # have been written to.
+    racy_ns = 2 * 1000 * 1000 * 1000
+    version = 3
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.hashes = {}
+        self.filters = {}
+
+    def connect(self):
+        conn = sqlite3.connect(self.dbfile)
+        if conn.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            for table in ('roots', 'dirs', 'files'):
+                conn.execute('DROP TABLE IF EXISTS ' + table)
+            conn.execute('PRAGMA user_version = %d' % self.version)
+        conn.execute('CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, filters TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS dirs (root TEXT, path TEXT, mtime_ns INTEGER, subdirs TEXT, '
+                     'excluded TEXT, PRIMARY KEY (root, path))')
+        conn.execute('CREATE TABLE IF NOT EXISTS files (root TEXT, dir TEXT, name TEXT, size INTEGER, '
+                     'mtime_ns INTEGER, hash TEXT, PRIMARY KEY (root, dir, name))')
+        return conn
+
+    def load(self, roots):
+        trees = {}
+        if not os.path.exists(self.dbfile):
+            return trees
+        with closing(self.connect()) as conn:
+            self.filters = dict(conn.execute('SELECT root, filters FROM roots'))
+            for root in roots:
+                nodes = {}
+                for path, mtime_ns, subdirs, excluded in conn.execute('SELECT path, mtime_ns, subdirs, excluded FROM dirs '
+                                                                      'WHERE root = ?', (root,)):
+                    # Names can not contain a slash on any platform.
+                    nodes[path] = Node(subdirs.split('/') if subdirs else [], [], {}, mtime_ns,
+                                       json.loads(excluded) if excluded else None)
+                for dirpath, name, size, mtime_ns, h in conn.execute('SELECT dir, name, size, mtime_ns, hash FROM files '
+                                                                     'WHERE root = ? ORDER BY dir, name', (root,)):
+                    node = nodes[dirpath]
+                    node.files.append(name)
+                    node.file_info[name] = FileInfo(size, mtime_ns)
+                    if h is not None:
+                        self.hashes[os.path.join(dirpath, name)] = (FileInfo(size, mtime_ns), h)
+                trees[root] = nodes
+        return trees
+
+    def hash_file(self, relpath, info, basedir):
+        cached = self.hashes.get(relpath)
+        if cached is not None and info is not None and cached[0] == info:
+            return cached[1]
+        h = hash_file(os.path.join(basedir, relpath))
+        if info is not None:
+            self.hashes[relpath] = (info, h)
+        return h
+
+    def save(self, trees, scan_start_ns, filters):
+        # Filters maps roots to the signatures of the filters they were
+        # scanned with. Listings made with other filters are not reused.
+        trusted = scan_start_ns - self.racy_ns
+        def dir_rows(root, nodes):
+            for path, node in nodes.items():
+                mtime_ns = node.mtime_ns if node.mtime_ns is not None and node.mtime_ns < trusted else None
+                if any(info.mtime_ns is None or info.mtime_ns >= trusted for info in node.file_info.values()):
+                    mtime_ns = None
+                yield root, path, mtime_ns, '/'.join(node.dirs), json.dumps(node.excluded) if node.excluded else None
+        def file_rows(root, nodes):
+            for dirpath, node in nodes.items():
+                for f in node.files:
+                    info = node.file_info.get(f, FileInfo(None, None))
+                    h = None
+                    cached = self.hashes.get(os.path.join(dirpath, f))
+                    if cached is not None and cached[0] == info and info.mtime_ns is not None and info.mtime_ns < trusted:
+                        h = cached[1]
+                    yield root, dirpath, f, info.size, info.mtime_ns, h
+        with closing(self.connect()) as conn:
+            with conn:
+                for root, nodes in trees.items():
+                    conn.execute('DELETE FROM dirs WHERE root = ?', (root,))
+                    conn.execute('DELETE FROM files WHERE root = ?', (root,))
+                    conn.execute('INSERT OR REPLACE INTO roots VALUES (?, ?)', (root, filters.get(root)))
+                    conn.executemany('INSERT INTO dirs VALUES (?, ?, ?, ?, ?)', dir_rows(root, nodes))
+                    conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', file_rows(root, nodes))
+
+class PollingWatcher:
+    # Notices changes to the staged trees by scanning them again every
+    # interval seconds. Listings of unmodified directories are reused and
+    # only their files are checked, see scan_directory.
+    name = 'polling'
+
+    def __init__(self, basedir, filters, roots, interval=1.0):
+        self.basedir = basedir
+        self.filters = filters
+        self.roots = roots
+        self.interval = interval
+
+    def scan(self, trees):
+        new_trees = dict(trees)
+        new_trees.update(scan_trees(self.roots, basedir=self.basedir, previous=trees, filters=self.filters, verify=True))
+        return new_trees
+
+    def changed(self, trees, new_trees):
+        for root in self.roots:
+            nodes = new_trees[root]
+            old_nodes = trees[root]
+            if old_nodes.keys() != nodes.keys():
+                return True
+            for path, node in nodes.items():
+                old = old_nodes[path]
+                if old.dirs != node.dirs or old.files != node.files or old.file_info != node.file_info:
+                    return True
+        return False
+
+    def wait(self, trees, delay):
+        # Returns the new trees once they have changed and then stayed the
+        # same for delay seconds.
+        while True:
+            time.sleep(self.interval)
+            new_trees = self.scan(trees)
+            if self.changed(trees, new_trees):
+                break
+        while True:
+            time.sleep(delay)
+            settled = self.scan(new_trees)
+            if not self.changed(new_trees, settled):
+                return settled
+            new_trees = settled
+
+class InotifyWatcher(PollingWatcher):
+    # Linux only. Every directory of the trees is watched, so that only
+    # the directories that have changed need to be listed again.
+    name = 'inotify'
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+    def __init__(self, basedir, filters, roots):
+        super().__init__(basedir, filters, roots)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Watch descriptors to (root, directory) and back.
+        self.wds = {}
+        self.watched = {}
+
+    def add_watches(self, trees):
+        # Returns False if a directory can not be watched, for example when
+        # fs.inotify.max_user_watches is reached. Inotify is then given up
+        # and the trees are polled from then on.
+        for root in self.roots:
+            for path in trees[root]:
+                if path in self.watched:
+                    continue
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.basedir, path)), self.MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.ENOENT:
+                        # Removed already, the next event says so.
+                        continue
+                    print('Can not watch %s (%s), polling for changes instead.' % (path, os.strerror(err)))
+                    os.close(self.fd)
+                    self.fd = None
+                    self.name = PollingWatcher.name
+                    return False
+                self.wds[wd] = (root, path)
+                self.watched[path] = wd
+        return True
+
+    def read_events(self, timeout):
+        # Returns the directories with events as (root, path) pairs, or
+        # None if events were lost, and an empty set on timeout.
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        buf = os.read(self.fd, 256 * 1024)
+        dirs = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = struct.unpack_from('iIII', buf, offset)
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if wd not in self.wds:
+                continue
+            if mask & self.IN_IGNORED:
+                # The directory is gone, its parent has an event for it.
+                root, path = self.wds.pop(wd)
+                if self.watched.get(path) == wd:
+                    del self.watched[path]
+                continue
+            dirs.add(self.wds[wd])
+        return dirs
+
+    def wait(self, trees, delay):
+        if self.fd is None or not self.add_watches(trees):
+            return super().wait(trees, delay)
+        changed = set()
+        timeout = None
+        while True:
+            dirs = self.read_events(timeout)
+            if dirs is None:
+                changed = None
+            elif not dirs and timeout is not None:
+                break
+            elif changed is not None:
+                changed |= dirs
+            timeout = delay
+        if changed is None:
+            new_trees = self.scan(trees)
+        else:
+            new_trees = dict(trees)
+            for root in self.roots:
+                dirs = [path for r, path in changed if r == root]
+                if dirs:
+                    new_trees[root] = update_tree(trees[root], root, dirs, self.basedir, self.filters.get(root))
+        self.add_watches(new_trees)
+        return new_trees
+
+def tree_watcher(basedir, filters, roots):
+    if platform.system() == 'Linux':
+        try:
+            return InotifyWatcher(basedir, filters, roots)
+        except (OSError, AttributeError) as e:
+            print('Inotify is not available (%s), polling for changes instead.' % e)
+    return PollingWatcher(basedir, filters, roots)
+
+WIX3_NAMESPACE = 'http://schemas.microsoft.com/wix/2006/wi'
+WIX4_NAMESPACE = 'http://wixtoolset.org/schemas/v4/wxs'
+# Elements of the WiX UI library, which wixl does not have.
+WIX_UI_ELEMENTS = ('UI', 'UIRef', 'WixUI')
+
+def wix4_to_wix3(root):
+    # Rewrites a document written by createmsi from the WiX 4 dialect to
+    # the WiX 3 one that wixl understands. Only the constructs that
+    # createmsi uses are handled.
+    for parent in root.iter():
+        for e in list(parent):
+            if e.tag.split('}')[-1] in WIX_UI_ELEMENTS:
+                parent.remove(e)
+    for e in root.iter():
+        e.tag = e.tag.split('}')[-1]
+    root.attrib = {'xmlns': WIX3_NAMESPACE}
+    for product in root.findall('Package'):
+        product.tag = 'Product'
+        attrs = dict(product.attrib)
+        product.attrib = {'Id': attrs.pop('ProductCode')}
+        product.attrib.update(attrs)
+        summary = product.find('SummaryInformation')
+        package = ET.Element('Package', {
+            'Id': '*',
+            'Keywords': summary.get('Keywords'),
+            'Description': summary.get('Description'),
+            'Manufacturer': summary.get('Manufacturer'),
+            'InstallerVersion': '500',
+            'InstallScope': 'perMachine',
+            'Languages': product.get('Language'),
+            'Compressed': 'yes',
+            'SummaryCodepage': product.get('Codepage'),
+        })
+        product.remove(summary)
+        product.insert(0, package)
+        # WiX 3 has all the directories in a single tree under TARGETDIR.
+        standard_dirs = [e for e in product if e.tag == 'StandardDirectory']
+        if standard_dirs:
+            targetdir = ET.Element('Directory', {'Id': 'TARGETDIR', 'Name': 'SourceDir'})
+            product.insert(list(product).index(standard_dirs[0]), targetdir)
+            merged = {}
+            for e in standard_dirs:
+                if e.get('Id') not in merged:
+                    merged[e.get('Id')] = ET.SubElement(targetdir, 'Directory', {'Id': e.get('Id'), 'Name': e.get('Id')})
+                merged[e.get('Id')].extend(list(e))
+                product.remove(e)
+    for feature in root.iter('Feature'):
+        if feature.attrib.pop('AllowAbsent', 'yes') == 'no':
+            feature.set('Absent', 'disallow')
+    return root
+
+class WixBackend:
+    # WiX 4, which runs on .NET. Supports everything createmsi does.
+    name = 'wix'
+    tool = 'wix'
+    requires = 'WIX 4'
+
+    def unsupported(self, generator):
+        return []
+
+    def build_package(self, generator):
+        g = generator
+        cmd_arr = ['wix',
+                   'build',
+                   '-ext', 'WixToolset.UI.wixext',
+                   #'-cultures:en-us',
+                   ]
+        if g.license_file:
+            cmd_arr += ['-bindvariable', 'WixUILicenseRtf=' + g.license_file]
+        if g.cab_cache is not None:
+            cmd_arr += ['-cc', g.cab_cache.cachedir]
+            g.cab_cache.prepare(g.cabinets)
+        cmd_arr += ['-arch', 'x64' if g.arch == 64 else 'x86',
+                    '-pdb', g.pdb_file,
+                    '-out', g.final_output,
+                    g.main_xml] + g.fragment_files
+        # Source paths in the WXS file are relative to the base dir.
+        subprocess.check_call(cmd_arr, cwd=g.basedir)
+        if g.cab_cache is not None:
+            g.cab_cache.update(g.cabinets)
+            g.cab_cache.report()
+
+    def build_module(self, generator, wxs, output):
+        subprocess.check_call(['wix', 'build',
+                               '-arch', 'x64' if generator.arch == 64 else 'x86',
+                               '-pdbtype', 'none',
+                               '-out', output, wxs], cwd=generator.basedir)
+
+    def build_patch(self, generator):
+        subprocess.check_call(['wix', 'build', '-out', generator.patch_file, generator.patch_xml], cwd=generator.outdir)
+
+class WixlBackend:
+    # Wixl from msitools, a native tool that reads the WiX 3 dialect. The
+    # generated files are converted to it before building.
+    name = 'wixl'
+    tool = 'wixl'
+    requires = 'msitools (wixl)'
+
+    def unsupported(self, generator):
+        errors = []
+        if generator.cab_cache is not None:
+            errors.append('The cabinet cache needs the wix backend.')
+        if generator.patch_from is not None:
+            errors.append('Patches need the wix backend.')
+        if any('staged_dir' in f for f in generator.modules):
+            errors.append('Building merge modules needs the wix backend.')
+        return errors
+
+    def convert(self, wxs):
+        converted = os.path.splitext(wxs)[0] + '.wixl.wxs'
+        root = wix4_to_wix3(ET.parse(wxs).getroot())
+        with open(converted, 'w', encoding='utf-8') as ofile:
+            w = WxsWriter(ofile)
+            w.write_tree(root)
+            w.close()
+        return converted
+
+    def build_package(self, generator):
+        g = generator
+        sources = [self.convert(wxs) for wxs in [g.main_xml] + g.fragment_files]
+        subprocess.check_call(['wixl',
+                               '--arch', 'x64' if g.arch == 64 else 'x86',
+                               '-o', g.final_output] + sources, cwd=g.basedir)
+
+BACKENDS = {'wix': WixBackend, 'wixl': WixlBackend}
+
+def find_backend(name=None):
+    # Without a name WiX is used, or wixl if only it is installed.
+    if name is None:
+        name = 'wixl' if shutil.which('wix') is None and shutil.which('wixl') is not None else 'wix'
+    return BACKENDS[name]()
 
 class UIGraphics:
     def __init__(self):
         self.banner = None
         self.background = None
 
+REQUIRED_KEYS = ('upgrade_guid', 'version', 'product_name', 'manufacturer', 'name', 'name_base',
+                 'comments', 'installdir', 'parts')
+REQUIRED_PART_KEYS = ('id', 'title', 'description', 'staged_dir')
+REQUIRED_REGISTRY_KEYS = ('root', 'key', 'name', 'type', 'value', 'key_path')
+REQUIRED_ACTION_KEYS = ('id', 'exe_command', 'execute', 'return', 'impersonate')
+REGISTRY_ROOTS = ('HKMU', 'HKCR', 'HKCU', 'HKLM', 'HKU')
+REGISTRY_TYPES = ('string', 'integer', 'binary', 'expandable', 'multiString')
+COMPRESSION_LEVELS = ('high', 'low', 'medium', 'mszip', 'none')
+# Longest path most Windows programs can open.
+MAX_PATH = 260
+# Component GUIDs of a merge module are derived from this and the part
+# id, so that they are the same in every product that uses it.
+MODULE_NAMESPACE = uuid.UUID('9750064C-0D9B-4CE4-917E-7C90F5DDFB85')
+
+def check_version(version):
+    # Windows Installer only looks at the first three fields.
+    limits = (255, 255, 65535, 65535)
+    fields = str(version).split('.')
+    return len(fields) <= 4 and all(f.isdigit() and int(f) <= l for f, l in zip(fields, limits))
+
+def check_definition(jsondata):
+    # Checks everything that can be checked without looking at the file
+    # system. Returns a list of all the problems found.
+    if not isinstance(jsondata, dict):
+        return ['The definition must be a JSON object.']
+    errors = []
+    for key in REQUIRED_KEYS:
+        if key not in jsondata:
+            errors.append('Missing required key "%s".' % key)
+    guids = [('upgrade_guid', jsondata.get('upgrade_guid'))]
+    if isinstance(jsondata.get('product_guid'), dict):
+        guids += [('product_guid', g) for g in jsondata['product_guid'].values()]
+    elif jsondata.get('product_guid', '*') != '*':
+        guids.append(('product_guid', jsondata['product_guid']))
+    for key, guid in guids:
+        if guid is None:
+            continue
+        try:
+            uuid.UUID(guid)
+        except (TypeError, ValueError, AttributeError):
+            errors.append('%s "%s" is not a valid GUID.' % (key, guid))
+    if 'version' in jsondata:
+        if not check_version(jsondata['version']):
+            errors.append('Version "%s" is not of the form major.minor.build with major and minor at most 255 '
+                          'and build at most 65535.' % jsondata['version'])
+    archs = jsondata.get('arch', 64)
+    if not isinstance(archs, list):
+        archs = [archs]
+    if not archs or len(set(archs)) != len(archs) or not all(a in (32, 64) for a in archs):
+        errors.append('Arch must be 32, 64 or a list of them without duplicates, not %s.' % jsondata['arch'])
+    if len(archs) > 1:
+        if isinstance(jsondata.get('product_guid', '*'), str) and jsondata.get('product_guid', '*') != '*':
+            errors.append('Product_guid must map every architecture to a GUID when building for several architectures.')
+        if jsondata.get('need_msvcrt', False) and isinstance(jsondata.get('redist_path'), str):
+            errors.append('Redist_path must map every architecture to a merge module when building for several architectures.')
+    for key in ('product_guid', 'redist_path'):
+        if isinstance(jsondata.get(key), dict) and not all(str(a) in jsondata[key] for a in archs):
+            errors.append('%s must have an entry for every architecture.' % key.capitalize())
+    if jsondata.get('component_strategy', 'directory') not in ('directory', 'file'):
+        errors.append('Unknown component strategy "%s", must be "directory" or "file".' % jsondata['component_strategy'])
+    parts = jsondata.get('parts', [])
+    if not isinstance(parts, list) or not parts:
+        errors.append('Parts must be a non-empty list.')
+        parts = []
+    ids = set()
+    staged_dirs = [p.get('staged_dir', p.get('install_manifest')) for p in parts if isinstance(p, dict)]
+    for i, part in enumerate(parts):
+        name = 'Part %d' % (i + 1)
+        if not isinstance(part, dict):
+            errors.append('%s must be an object.' % name)
+            continue
+        if 'id' in part:
+            name = 'Part %s' % part['id']
+            if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_.]{0,71}', str(part['id'])):
+                errors.append('%s: the id must be an identifier of at most 72 characters.' % name)
+            if part['id'] in ids:
+                errors.append('%s: the id is used by more than one part.' % name)
+            ids.add(part['id'])
+        for key in REQUIRED_PART_KEYS:
+            if key not in part and not (key == 'staged_dir' and ('merge_module' in part or 'install_manifest' in part)):
+                errors.append('%s is missing required key "%s".' % (name, key))
+        if 'install_manifest' in part:
+            if 'staged_dir' in part or 'merge_module' in part:
+                errors.append('%s must have only one of staged_dir, install_manifest and merge_module.' % name)
+            if 'include' in part or 'exclude' in part:
+                errors.append('%s: include and exclude can not be used with install_manifest.' % name)
+        if 'merge_module' in part:
+            if 'staged_dir' in part:
+                errors.append('%s must have either staged_dir or merge_module, not both.' % name)
+            module = part['merge_module']
+            if isinstance(module, dict):
+                if not all(str(a) in module for a in archs):
+                    errors.append('%s: merge_module must have an entry for every architecture.' % name)
+            elif not isinstance(module, str):
+                errors.append('%s: merge_module must be a file name or a dictionary of them by architecture.' % name)
+        if part.get('build_module', False):
+            if staged_dirs.count(part.get('staged_dir')) > 1:
+                errors.append('%s: the staged_dir of a merge module can not be used by other parts.' % name)
+            if not check_version(part.get('version', '1.0')):
+                errors.append('%s: version "%s" is not a valid version.' % (name, part['version']))
+        sd = str(part.get('staged_dir', ''))
+        if '/' in sd or '\\' in sd:
+            errors.append('%s: staged_dir %s must not have a path segment.' % (name, sd))
+        if part.get('absent', 'allow') not in ('allow', 'disallow'):
+            errors.append('%s: absent must be "allow" or "disallow".' % name)
+        if part.get('compression', 'none') not in COMPRESSION_LEVELS:
+            errors.append('%s: compression must be one of %s.' % (name, ', '.join(COMPRESSION_LEVELS)))
+        for key in ('include', 'exclude'):
+            if not isinstance(part.get(key, []), list) or not all(isinstance(p, str) for p in part.get(key, [])):
+                errors.append('%s: %s must be a list of glob patterns.' % (name, key))
+        if isinstance(part.get('include', []), list):
+            for p in part.get('include', []):
+                if isinstance(p, str) and dir_pattern(p):
+                    errors.append('%s: include pattern %s ends in a slash, but includes only apply to files.' % (name, p))
+    for i, reg in enumerate(jsondata.get('registry_entries', [])):
+        name = 'Registry entry %d' % (i + 1)
+        for key in REQUIRED_REGISTRY_KEYS:
+            if key not in reg:
+                errors.append('%s is missing required key "%s".' % (name, key))
+        if 'root' in reg and reg['root'] not in REGISTRY_ROOTS:
+            errors.append('%s: root must be one of %s, not %s.' % (name, ', '.join(REGISTRY_ROOTS), reg['root']))
+        if 'type' in reg and reg['type'] not in REGISTRY_TYPES:
+            errors.append('%s: type must be one of %s, not %s.' % (name, ', '.join(REGISTRY_TYPES), reg['type']))
+    for i, action in enumerate(jsondata.get('custom_actions', [])):
+        name = 'Custom action %s' % action.get('id', i + 1)
+        for key in REQUIRED_ACTION_KEYS:
+            if key not in action:
+                errors.append('%s is missing required key "%s".' % (name, key))
+        if ('after' in action) == ('before' in action):
+            errors.append('%s must have exactly one of "after" and "before".' % name)
+    return errors
+
+def format_errors(name, errors):
+    return '%s is not valid:\n' % name + '\n'.join('  ' + e for e in errors)
+
 class PackageGenerator:
 
-    def __init__(self, jsonfile):
-        jsondata = json.load(open(jsonfile, 'rb'))
+    def __init__(self, definition, basedir=None, outdir=None, scan_workers=None, inventory=None,
+                 cab_cache=None, cab_cache_size=10*1024, report=False, report_hooks=None, tree_index=False,
+                 arch=None, patch_from=None, backend=None, verify_index=False):
+        # The definition is either the name of a JSON file or an already
+        # parsed dict. Relative paths in it are relative to basedir, which
+        # defaults to the directory of the JSON file (or the current
+        # directory for a dict). Outputs go to outdir, which defaults to
+        # basedir. An inventory from scan_trees or tree_from_paths, keyed
+        # by staged_dir, can be given to skip scanning the file system.
+        # The build report is written if report is set or the environment
+        # variable MSICREATOR_REPORT is set to a non-empty value. With
+        # tree_index the scanned trees are kept in an index in outdir to
+        # make the next scan faster. The files in directories that have
+        # not changed are taken from it as they are, unless verify_index
+        # is set. If the definition lists several architectures, arch
+        # selects the one to generate for. A patch against the earlier
+        # build found in the directory patch_from is made with
+        # build_patch. Backend is the name of the tool used to build the
+        # package, see find_backend.
+        self.report = BuildReport(report or bool(os.environ.get('MSICREATOR_REPORT')), report_hooks)
+        if isinstance(definition, dict):
+            jsondata = definition
+            if basedir is None:
+                basedir = os.getcwd()
+        else:
+            with open(definition, 'rb') as f:
+                jsondata = json.load(f)
+            if basedir is None:
+                basedir = os.path.dirname(definition)
+        self.definition_name = definition if not isinstance(definition, dict) else 'The definition'
+        errors = check_definition(jsondata)
+        if errors:
+            sys.exit(format_errors(self.definition_name, errors))
+        self.basedir = os.path.abspath(basedir)
+        self.outdir = os.path.abspath(outdir) if outdir is not None else self.basedir
+        self.jsondata = jsondata
         self.product_name = jsondata['product_name']
         self.manufacturer = jsondata['manufacturer']
         self.version = jsondata['version']
@@ -54,9 +1189,28 @@ class PackageGenerator:
         self.addremove_icon = jsondata.get('addremove_icon', None)
         self.startmenu_shortcut = jsondata.get('startmenu_shortcut', None)
         self.desktop_shortcut = jsondata.get('desktop_shortcut', None)
-        self.main_xml = self.basename + '.wxs'
+        self.deterministic_ids = jsondata.get('deterministic_ids', False)
+        self.uuid_namespace = uuid.UUID(self.upgrade_guid)
+        self.deduplicate = jsondata.get('deduplicate', False)
+        self.manifest = jsondata.get('manifest', False)
+        # SHA-256 of staged files by path, filled in as they get hashed.
+        self.file_hashes = {}
+        self.max_cab_size = None
+        if 'max_cab_size_mb' in jsondata:
+            self.max_cab_size = jsondata['max_cab_size_mb'] * 1024 * 1024
+        self.component_strategy = jsondata.get('component_strategy', 'directory')
+        self.max_component_files = jsondata.get('max_component_files', None)
+        self.max_component_size = None
+        if 'max_component_size_mb' in jsondata:
+            self.max_component_size = jsondata['max_component_size_mb'] * 1024 * 1024
+        # Explicit key paths are only needed when a directory is not a single
+        # component, the default output stays as it has always been.
+        self.explicit_key_paths = (self.component_strategy == 'file' or
+                                   self.max_component_files is not None or
+                                   self.max_component_size is not None)
+        self.part_fragments = jsondata.get('part_fragments', False)
+        self.fragment_files = []
         self.main_o = self.basename + '.wixobj'
-        self.idnum = 0
         self.graphics = UIGraphics()
         if 'graphics' in jsondata:
             if 'banner' in jsondata['graphics']:
@@ -64,48 +1218,369 @@ class PackageGenerator:
             if 'background' in jsondata['graphics']:
                 self.graphics.background = jsondata['graphics']['background']
         if 'arch' in jsondata:
-            self.arch = jsondata['arch']
+            self.archs = jsondata['arch'] if isinstance(jsondata['arch'], list) else [jsondata['arch']]
         else:
             # rely on the environment variable since python architecture may not be the same as system architecture
             if 'PROGRAMFILES(X86)' in os.environ:
-                self.arch = 64
+                self.archs = [64]
             else:
-                self.arch = 32 if '32' in platform.architecture()[0] else 64
-        self.final_output = '%s-%s-%d.msi' % (self.basename, self.version, self.arch)
+                self.archs = [32 if '32' in platform.architecture()[0] else 64]
+        self.arch = arch if arch is not None else self.archs[0]
+        if isinstance(self.guid, dict):
+            self.guid = self.guid[str(self.arch)]
+        # Generated files of different architectures must not overwrite
+        # each other.
+        if len(self.archs) > 1:
+            self.wxs_base = '%s-%d' % (self.basename, self.arch)
+        else:
+            self.wxs_base = self.basename
+        self.main_xml = os.path.join(self.outdir, self.wxs_base + '.wxs')
+        self.final_output = os.path.join(self.outdir, '%s-%s-%d.msi' % (self.basename, self.version, self.arch))
+        self.fingerprint_file = self.final_output + '.fingerprint'
+        self.report_file = self.final_output + '.report.json'
+        self.manifest_file = self.final_output + '.manifest.json'
+        self.pdb_file = os.path.splitext(self.final_output)[0] + '.wixpdb'
+        self.patch_from = patch_from
+        self.patch_xml = os.path.join(self.outdir, self.wxs_base + '.patch.wxs')
+        self.patch_file = os.path.splitext(self.final_output)[0] + '.msp'
+        if patch_from is not None:
+            # Changes are found by comparing the manifests.
+            self.manifest = True
         if self.arch == 64:
             self.progfile_dir = 'ProgramFiles64Folder'
-            if platform.system() == "Windows":
-                redist_glob = 'C:\\Program Files\\Microsoft Visual Studio\\*\\*\\VC\\Redist\\MSVC\\v*\\MergeModules\\Microsoft_VC*_CRT_x64.msm'
-            else:
-                redist_glob = '/usr/share/msicreator/Microsoft_VC141_CRT_x64.msm'
         else:
             self.progfile_dir = 'ProgramFilesFolder'
-            if platform.system() == "Windows":
-                redist_glob = 'C:\\Program Files\\Microsoft Visual Studio\\*\\Community\\VC\\Redist\\MSVC\\*\\MergeModules\\Microsoft_VC*_CRT_x86.msm'
-            else:
-                redist_glob = '/usr/share/msicreator/Microsoft_VC141_CRT_x86.msm'
-        trials = glob(redist_glob)
         if self.need_msvcrt:
-            if len(trials) > 1:
-                sys.exit('There are more than one redist dirs: ' + 
-                         ', '.join(trials))
-            if len(trials) == 0:
-                sys.exit('No redist dirs were detected, install MSM redistributables with VS installer.')
-            self.redist_path = trials[0]
-        self.component_num = 0
+            if isinstance(jsondata.get('redist_path'), dict):
+                self.redist_path = jsondata['redist_path'][str(self.arch)]
+            elif 'redist_path' in jsondata:
+                self.redist_path = jsondata['redist_path']
+            else:
+                with self.report.phase('redist_discovery'):
+                    self.redist_path = find_redist(self.arch)
         self.registry_entries = jsondata.get('registry_entries', None)
         self.major_upgrade = jsondata.get('major_upgrade', None)
         self.custom_actions = jsondata.get('custom_actions', None)
-        self.parts = jsondata['parts']
-        self.feature_components = {}
-        self.feature_properties = {}
+        # Parts that are merge modules, either prebuilt or built from their
+        # staged_dir, are kept apart from the parts installed directly.
+        # The tree of a part with an install manifest is named after the
+        # manifest and used in place of a staged_dir everywhere.
+        parts = [dict(f, staged_dir=f['install_manifest']) if 'install_manifest' in f else f for f in jsondata['parts']]
+        self.manifest_parts = {f['staged_dir']: f for f in parts if 'install_manifest' in f}
+        self.parts = [f for f in parts if not f.get('build_module', False) and 'merge_module' not in f]
+        self.modules = [f for f in parts if f.get('build_module', False) or 'merge_module' in f]
+        self.staged_parts = [f for f in parts if 'staged_dir' in f]
+        # What deterministic IDs are keyed on besides the path inside the
+        # part. Modules are merged elsewhere and shared between products,
+        # so their IDs do not depend on the installdir.
+        self.id_roots = {f['staged_dir']: ('' if f in self.modules else self.installdir + '/') + f['id']
+                         for f in self.staged_parts}
+        self.module_cache = os.path.join(cache_dir(), 'modules')
+        self.scan_workers = scan_workers
+        self.trees = inventory
+        self.changes = None
+        self.index = None
+        self.verify_index = verify_index
+        if tree_index or verify_index:
+            self.index = TreeIndex(os.path.join(self.outdir, self.basename + '.index.sqlite'))
+        self.cab_cache = None
+        if cab_cache is not None:
+            self.cab_cache = CabinetCache(cab_cache, cab_cache_size * 1024 * 1024)
+        self.backend = find_backend(backend)
+
+    def path(self, fname):
+        return os.path.join(self.basedir, fname)
+
+    def scan(self):
+        staged_dirs = []
+        for f in self.staged_parts:
+            sd = f['staged_dir']
+            if sd in self.manifest_parts:
+                continue
+            if '/' in sd or '\\' in sd:
+                sys.exit('Staged_dir %s must not have a path segment.' % sd)
+            if not os.path.isdir(self.path(sd)):
+                sys.exit('Staged_dir %s does not exist.' % sd)
+            if sd not in staged_dirs:
+                staged_dirs.append(sd)
+        self.filters = {}
+        filter_signatures = {}
+        for f in self.staged_parts:
+            sd = f['staged_dir']
+            if sd in self.manifest_parts:
+                continue
+            path_filter = PathFilter(sd, f.get('include'), f.get('exclude'))
+            if filter_signatures.setdefault(sd, path_filter.signature()) != path_filter.signature():
+                sys.exit('Parts with the same staged_dir %s must have the same include and exclude patterns.' % sd)
+            if path_filter.include or path_filter.exclude:
+                self.filters[sd] = path_filter
+        with self.report.phase('scan'):
+            manifest_trees = {}
+            for root, f in self.manifest_parts.items():
+                pairs = read_install_manifest(f['install_manifest'], f.get('install_prefix'), self.basedir)
+                manifest_trees[root] = tree_from_manifest(root, pairs, self.basedir, self.scan_workers)
+            if self.index is None:
+                self.trees = scan_trees(staged_dirs, self.scan_workers, self.basedir, filters=self.filters)
+                self.trees.update(manifest_trees)
+                return
+            self.scan_start_ns = time.time_ns()
+            self.filter_signatures = filter_signatures
+            previous = self.index.load(staged_dirs)
+            reusable = {sd: nodes for sd, nodes in previous.items()
+                        if self.index.filters.get(sd) == filter_signatures[sd]}
+            self.trees = scan_trees(staged_dirs, self.scan_workers, self.basedir, reusable, self.filters, self.verify_index)
+            self.trees.update(manifest_trees)
+            self.changes = {sd: tree_changes(previous.get(sd, {}), self.trees[sd]) for sd in staged_dirs}
+        self.report.set('changes', {sd: {'added': len(c.added),
+                                         'removed': len(c.removed),
+                                         'modified': len(c.modified),
+                                         } for sd, c in self.changes.items()})
+
+    def validate(self):
+        # Checks the definition against the file system and the staged
+        # files. Returns a list of all the problems found, nothing gets
+        # written.
+        errors = []
+        extra_files = [('license_file', self.license_file),
+                       ('addremove_icon', self.addremove_icon),
+                       ('Graphics banner', self.graphics.banner),
+                       ('Graphics background', self.graphics.background),
+                       ]
+        # Files given per architecture are checked for all of them, so
+        # that the other architectures do not need a validation of their
+        # own.
+        if self.need_msvcrt:
+            if isinstance(self.jsondata.get('redist_path'), dict):
+                extra_files += [('redist_path', self.jsondata['redist_path'][str(a)]) for a in self.archs]
+            else:
+                extra_files.append(('redist_path', self.redist_path))
+        for f in self.modules:
+            if 'merge_module' in f:
+                extra_files += [('Part %s merge_module' % f['id'], self.module_path(f, a)) for a in self.archs]
+        for key, fname in dict.fromkeys(extra_files):
+            if fname is not None and not os.path.isfile(self.path(fname)):
+                errors.append('%s %s does not exist.' % (key, fname))
+        missing = [f['staged_dir'] for f in self.staged_parts
+                   if f['staged_dir'] not in self.manifest_parts and not os.path.isdir(self.path(f['staged_dir']))]
+        for sd in missing:
+            errors.append('Staged_dir %s does not exist.' % sd)
+        for f in self.manifest_parts.values():
+            if not os.path.isfile(self.path(f['install_manifest'])):
+                errors.append('Install manifest %s does not exist.' % f['install_manifest'])
+                missing.append(f['install_manifest'])
+        if self.patch_from is not None:
+            if not self.deterministic_ids:
+                errors.append('Patches need "deterministic_ids": true so that unchanged components keep their IDs.')
+            if self.guid == '*':
+                errors.append('Patches need a fixed product_guid, the patched and the new package must have the same product code.')
+            if not os.path.isdir(self.patch_from):
+                errors.append('Patch baseline directory %s does not exist.' % self.patch_from)
+        errors += self.backend.unsupported(self)
+        if missing:
+            return errors
+        if self.trees is None:
+            self.scan()
+        return errors + self.check_inventory()
+
+    def check_inventory(self):
+        errors = []
+        def add_errors(kind):
+            # Something like overlapping parts can give a huge number of
+            # errors, only some of them are shown.
+            errors.extend(kind[:10])
+            if len(kind) > 10:
+                errors.append('... and %d more like the above.' % (len(kind) - 10))
+        # Installed paths as Windows sees them, without case.
+        installed = {}
+        collisions = []
+        too_long = []
+        root = 'C:\\Program Files (x86)\\' if 32 in self.archs else 'C:\\Program Files\\'
+        prefix_len = len(root) + len(self.installdir) + 1
+        for sd in dict.fromkeys(f['staged_dir'] for f in self.staged_parts):
+            part_id = next(f['id'] for f in self.staged_parts if f['staged_dir'] == sd)
+            for dirpath, node in self.trees[sd].items():
+                reldir = dirpath[len(sd) + 1:]
+                for fname in node.files:
+                    relpath = os.path.join(reldir, fname) if reldir else fname
+                    key = relpath.replace('/', '\\').lower()
+                    if key in installed:
+                        other_part, other_path = installed[key]
+                        if other_part == part_id:
+                            collisions.append('Part %s: %s and %s differ only in case.' % (part_id, other_path, relpath))
+                        else:
+                            collisions.append('%s is in both part %s and part %s.' % (relpath, other_part, part_id))
+                    else:
+                        installed[key] = (part_id, relpath)
+                    if prefix_len + len(relpath) >= MAX_PATH:
+                        too_long.append('%s would be %d characters long when installed, over the limit of %d.'
+                                        % (relpath, prefix_len + len(relpath), MAX_PATH - 1))
+        add_errors(collisions)
+        add_errors(too_long)
+        for key, target in [('startmenu_shortcut', self.startmenu_shortcut), ('desktop_shortcut', self.desktop_shortcut)]:
+            if target is not None and target.replace('/', '\\').lower() not in installed:
+                errors.append('%s target %s is not in any part.' % (key, target))
+        return errors
+
+    def check(self):
+        with self.report.phase('validate'):
+            errors = self.validate()
+        if errors:
+            sys.exit(format_errors(self.definition_name, errors))
+
+    def save_index(self):
+        # Nothing to save if the trees came from an inventory.
+        if self.index is not None and self.changes is not None:
+            os.makedirs(self.outdir, exist_ok=True)
+            with self.report.phase('save_index'):
+                self.index.save({sd: self.trees[sd] for sd in self.filter_signatures}, self.scan_start_ns, self.filter_signatures)
+
+    def source_path(self, relpath):
+        if not self.manifest_parts:
+            return relpath
+        dirpath, fname = os.path.split(relpath)
+        for nodes in self.trees.values():
+            node = nodes.get(dirpath)
+            if node is not None and fname in node.sources:
+                return node.sources[fname]
+        return relpath
+
+    def content_hash(self, relpath, info=None):
+        relpath = self.source_path(relpath)
+        if self.index is None:
+            return hash_file(self.path(relpath))
+        return self.index.hash_file(relpath, info, self.basedir)
+
+    def fingerprint(self, hash_contents=False):
+        # Everything that can affect the output goes in here. Staged files
+        # are identified by size and mtime unless hash_contents is set.
+        if self.trees is None:
+            self.scan()
+        h = Fingerprint()
+        add = h.add
+        add(hash_file(os.path.abspath(__file__)))
+        add(platform.system(), self.arch)
+        # Packages built by wixl or without cabinet reuse are not the same.
+        add(self.backend.name, self.cab_cache is not None)
+        add(json.dumps(self.jsondata, sort_keys=True))
+        if self.patch_from is not None:
+            # Patch mode keeps the manifest and the .wixpdb file.
+            add('patch', os.path.abspath(self.patch_from))
+        extra_files = [self.license_file, self.addremove_icon, self.graphics.banner, self.graphics.background]
+        if self.need_msvcrt:
+            extra_files.append(self.redist_path)
+        extra_files += [self.module_path(f) for f in self.modules if 'merge_module' in f]
+        for fname in extra_files:
+            if fname is None:
+                continue
+            add(fname)
+            fname = self.path(fname)
+            if os.path.exists(fname):
+                st = os.stat(fname)
+                add(st.st_size, hash_file(fname) if hash_contents else st.st_mtime_ns)
+        for sd in sorted(self.trees):
+            self.hash_tree(add, self.trees[sd], hash_contents)
+        return h.hexdigest()
+
+    def hash_tree(self, add, nodes, hash_contents=False):
+        for dirpath in sorted(nodes):
+            node = nodes[dirpath]
+            add(dirpath, len(node.dirs))
+            for f in node.files:
+                info = node.file_info.get(f, FileInfo(None, None))
+                if hash_contents:
+                    add(f, info.size, self.content_hash(os.path.join(dirpath, f), info))
+                else:
+                    add(f, info.size, info.mtime_ns)
+                if f in node.sources:
+                    # Files of install manifests can move without changing.
+                    add(node.sources[f])
+
+    def is_up_to_date(self, fingerprint):
+        if not os.path.exists(self.final_output) or not os.path.exists(self.fingerprint_file):
+            return False
+        with open(self.fingerprint_file) as f:
+            return f.read().strip() == fingerprint
+
+    def finish_report(self):
+        # The hooks get the report even if it is not written out.
+        self.report.set('package', os.path.basename(self.final_output))
+        if self.cab_cache is not None:
+            self.report.set('cabinet_cache', {'hits': len(self.cab_cache.hits),
+                                              'misses': len(self.cab_cache.misses),
+                                              'evicted': len(self.cab_cache.evicted),
+                                              })
+        result = self.report.finish()
+        if self.report.enabled:
+            with open(self.report_file, 'w') as f:
+                json.dump(result, f, indent=2)
+
+    def write_fingerprint(self, fingerprint):
+        with open(self.fingerprint_file, 'w') as f:
+            f.write(fingerprint + '\n')
 
     def generate_files(self):
-        self.root = ET.Element('Wix', {
+        os.makedirs(self.outdir, exist_ok=True)
+        with self.report.phase('generate'):
+            with open(self.main_xml, 'w', encoding='utf-8') as ofile:
+                self.write_document_to(ofile)
+            if self.manifest:
+                self.write_manifest()
+
+    def generate_wxs(self):
+        buf = io.StringIO()
+        self.write_wxs(buf)
+        return buf.getvalue().encode('utf-8')
+
+    def write_wxs(self, ofile):
+        # Part fragments and merge modules are files of their own next to
+        # the main document, which only generate_files writes.
+        if self.part_fragments:
+            sys.exit('Part_fragments can only be used with generate_files.')
+        if any(f.get('build_module', False) for f in self.modules):
+            sys.exit('Parts with build_module can only be used with generate_files.')
+        self.write_document_to(ofile)
+
+    def write_document_to(self, ofile):
+        self.start_document(ofile)
+        self.write_document()
+        self.writer.close()
+
+    def start_document(self, ofile):
+        self.idnum = 0
+        self.component_num = 0
+        self.feature_components = {}
+        self.feature_properties = {}
+        self.content_keys = {}
+        self.content_originals = {}
+        self.file_ids = {}
+        self.dedup_files = 0
+        self.dedup_bytes = 0
+        self.id_prefix = ''
+        self.pending_modules = []
+        self.need_environment = platform.system() == "Windows"
+        self.writer = WxsWriter(ofile)
+
+    def write_document(self):
+        # The directory tree can be huge, so it is streamed straight to
+        # the output file. Only the small fixed parts of the document are
+        # built as ElementTree elements before being written out.
+        if self.trees is None:
+            self.scan()
+        if self.manifest:
+            with self.report.phase('hash'):
+                self.hash_files([(os.path.join(dirpath, f), node.file_info.get(f))
+                                 for sd in dict.fromkeys(f['staged_dir'] for f in self.parts)
+                                 for dirpath, node in self.trees[sd].items() for f in node.files])
+        self.module_sources = {}
+        if self.modules:
+            with self.report.phase('modules'):
+                self.module_sources = {f['id']: self.module_source(f) for f in self.modules}
+        w = self.writer
+        w.start('Wix', {
             'xmlns': 'http://wixtoolset.org/schemas/v4/wxs',
             'xmlns:ui': 'http://wixtoolset.org/schemas/v4/wxs/ui'
         })
-        package = ET.SubElement(self.root, 'Package', {
+        w.start('Package', {
             'Name': self.product_name,
             'Manufacturer': self.manufacturer,
             'ProductCode': self.guid,
@@ -115,42 +1590,66 @@ class PackageGenerator:
             'Version': self.version,
         })
 
-        ET.SubElement(package, 'SummaryInformation',  {
+        w.element('SummaryInformation',  {
             'Keywords': 'Installer',
             'Description': '%s %s installer' % (self.name, self.version),
             'Manufacturer': self.manufacturer,
         })
 
         if self.major_upgrade is not None:
-            majorupgrade = ET.SubElement(package, 'MajorUpgrade', {})
+            majorupgrade = ET.Element('MajorUpgrade', {})
             for mkey in self.major_upgrade.keys():
                 majorupgrade.set(mkey, self.major_upgrade[mkey])
+            w.write_tree(majorupgrade)
         else:
-            ET.SubElement(package, 'MajorUpgrade', {'DowngradeErrorMessage': 'A newer version of %s is already installed.' % self.name})
-        ET.SubElement(package, 'Media', {
-            'Id': '1',
-            'Cabinet': self.basename + '.cab',
-            'EmbedCab': 'yes',
+            w.element('MajorUpgrade', {'DowngradeErrorMessage': 'A newer version of %s is already installed.' % self.name})
+        self.plan_media()
+        for feature, wxs, _ in self.pending_modules:
+            self.write_module(feature, wxs)
+        if self.cab_cache is None:
+            self.write_media()
+        w.start('StandardDirectory', {
+            'Id': self.progfile_dir,
         })
-        targetdir = ET.SubElement(package, 'StandardDirectory', {
-            'Id': 'ProgramFiles64Folder',
-        })
-        installdir = ET.SubElement(targetdir, 'Directory', {
+        w.start('Directory', {
             'Id': 'INSTALLDIR',
             'Name': self.installdir,
         })
         if self.need_msvcrt:
-            ET.SubElement(installdir, 'Merge', {
+            w.element('Merge', {
                 'Id': 'VCRedist',
                 'SourceFile': self.redist_path,
                 'DiskId': '1',
                 'Language': '0',
             })
+        for f in self.modules:
+            w.element('Merge', {
+                'Id': f['id'],
+                'SourceFile': self.module_sources[f['id']],
+                'DiskId': '1',
+                'Language': '0',
+            })
+
+        if self.part_fragments:
+            self.write_fragments()
+        else:
+            if self.deduplicate:
+                with self.report.phase('deduplicate'):
+                    self.find_duplicates()
+            for f in self.parts:
+                self.scan_feature(f)
+        if self.deduplicate:
+            self.report.set('deduplication', {'files': self.dedup_files, 'bytes': self.dedup_bytes})
+        w.end() # Directory
+        w.end() # StandardDirectory
+        if self.cab_cache is not None:
+            # Cabinet names depend on the file IDs, which are only known now.
+            self.write_media()
 
         if self.startmenu_shortcut is not None:
-            ap = ET.SubElement(package, 'StandardDirectory', {'Id': 'ProgramMenuFolder'})
+            ap = ET.Element('StandardDirectory', {'Id': 'ProgramMenuFolder'})
             comp = ET.SubElement(ap, 'Component', {'Id': 'ApplicationShortcut',
-                                                   'Guid': gen_guid(),
+                                                   'Guid': self.component_guid('ApplicationShortcut'),
                                                    })
             ET.SubElement(comp, 'Shortcut', {'Id': 'ApplicationStartMenuShortcut',
                                              'Name': self.product_name,
@@ -166,10 +1665,11 @@ class PackageGenerator:
                                                   'Value': '1',
                                                   'KeyPath': 'yes',
                                                   })
+            w.write_tree(ap)
         if self.desktop_shortcut is not None:
-            desk = ET.SubElement(package, 'StandardDirectory', {'Id': 'DesktopFolder'})
+            desk = ET.Element('StandardDirectory', {'Id': 'DesktopFolder'})
             comp = ET.SubElement(desk, 'Component', {'Id':'ApplicationShortcutDesktop',
-                                                     'Guid': gen_guid(),
+                                                     'Guid': self.component_guid('ApplicationShortcutDesktop'),
                                                      })
             ET.SubElement(comp, 'Shortcut', {'Id': 'ApplicationDesktopShortcut',
                                              'Name': self.product_name,
@@ -188,27 +1688,28 @@ class PackageGenerator:
                                                   'Value': '1',
                                                   'KeyPath': 'yes',
                                                   })
+            w.write_tree(desk)
 
         if platform.system() == "Windows":
             if self.license_file:
-                ET.SubElement(package, 'ui:WixUI', {
+                w.element('ui:WixUI', {
                     'Id': 'WixUI_FeatureTree',
                 })
             else:
-                self.create_licenseless_dialog_entries(package)
+                self.create_licenseless_dialog_entries()
 
         if self.graphics.banner is not None:
-            ET.SubElement(package, 'WixVariable', {
+            w.element('WixVariable', {
                 'Id': 'WixUIBannerBmp',
                 'Value': self.graphics.banner,
             })
         if self.graphics.background is not None:
-            ET.SubElement(package, 'WixVariable', {
+            w.element('WixVariable', {
                 'Id': 'WixUIDialogBmp', 
                 'Value': self.graphics.background,
             })
 
-        top_feature = ET.SubElement(package, 'Feature', {
+        w.start('Feature', {
             'Id': 'Complete',
             'Title': self.name + ' ' + self.version,
             'Description': 'The complete package',
@@ -218,50 +1719,68 @@ class PackageGenerator:
         })
 
         for f in self.parts:
-            self.scan_feature(top_feature, installdir, 1, f)
+            if self.part_fragments:
+                w.element('FeatureRef', {'Id': f['id']})
+            else:
+                self.build_features(f['staged_dir'])
+        for f in self.modules:
+            fdict = {
+                'Id': f['id'],
+                'Title': f['title'],
+                'Description': f['description'],
+                'Level': '1'
+            }
+            if f.get('absent', 'ab') == 'disallow':
+                fdict['AllowAbsent'] = 'no'
+            w.start('Feature', fdict)
+            w.element('MergeRef', {'Id': f['id']})
+            w.end()
 
         if self.need_msvcrt:
-            vcredist_feature = ET.SubElement(top_feature, 'Feature', {
+            w.start('Feature', {
                 'Id': 'VCRedist',
                 'Title': 'Visual C++ runtime',
                 'AllowAdvertise': 'no',
                 'Display': 'hidden',
                 'Level': '1',
             })
-            ET.SubElement(vcredist_feature, 'MergeRef', {'Id': 'VCRedist'})
+            w.element('MergeRef', {'Id': 'VCRedist'})
+            w.end()
         if self.startmenu_shortcut is not None:
-            ET.SubElement(top_feature, 'ComponentRef', {'Id': 'ApplicationShortcut'})
+            w.element('ComponentRef', {'Id': 'ApplicationShortcut'})
         if self.desktop_shortcut is not None:
-            ET.SubElement(top_feature, 'ComponentRef', {'Id': 'ApplicationShortcutDesktop'})
+            w.element('ComponentRef', {'Id': 'ApplicationShortcutDesktop'})
+        if self.registry_entries is not None:
+            w.element('ComponentRef', {'Id': 'RegistryEntries'})
+        w.end() # Feature
+
         if self.addremove_icon is not None:
             icoid = 'addremoveicon.ico'
-            ET.SubElement(package, 'Icon', {'Id': icoid,
-                                            'SourceFile': self.addremove_icon,
+            w.element('Icon', {'Id': icoid,
+                               'SourceFile': self.addremove_icon,
             })
-            ET.SubElement(package, 'Property', {'Id': 'ARPPRODUCTICON',
-                                                'Value': icoid,
+            w.element('Property', {'Id': 'ARPPRODUCTICON',
+                                   'Value': icoid,
             })
 
         if self.registry_entries is not None:
-            registry_entries_directory = targetdir = ET.SubElement(package, 'StandardDirectory', {
-                'Id': 'ProgramFiles64Folder',
+            registry_entries_directory = ET.Element('StandardDirectory', {
+                'Id': self.progfile_dir,
             })
-            registry_entries_component = ET.SubElement(registry_entries_directory, 'Component', {'Id': 'RegistryEntries', 'Guid': gen_guid()})
-            ET.SubElement(top_feature, 'ComponentRef', {'Id': 'RegistryEntries'})
+            registry_entries_component = ET.SubElement(registry_entries_directory, 'Component', {'Id': 'RegistryEntries', 'Guid': self.component_guid('RegistryEntries')})
             for r in self.registry_entries:
                 self.create_registry_entries(registry_entries_component, r)
+            w.write_tree(registry_entries_directory)
 
         if self.custom_actions is not None:
-            install_execute_sequence = ET.SubElement(package, 'InstallExecuteSequence')
-            for f in self.custom_actions:
-                self.create_custom_actions(package, install_execute_sequence, f)
+            install_execute_sequence = ET.Element('InstallExecuteSequence')
+            actions = [self.create_custom_actions(install_execute_sequence, f) for f in self.custom_actions]
+            w.write_tree(install_execute_sequence)
+            for a in actions:
+                w.write_tree(a)
 
-        ET.ElementTree(self.root).write(self.main_xml, encoding='utf-8', xml_declaration=True)
-        # ElementTree can not do prettyprinting so do it manually
-        import xml.dom.minidom
-        doc = xml.dom.minidom.parse(self.main_xml)
-        with open(self.main_xml, 'w') as of:
-            of.write(doc.toprettyxml(indent=' '))
+        w.end() # Package
+        w.end() # Wix
 
     def create_registry_entries(self, comp, reg):
         reg_key = ET.SubElement(comp, 'RegistryKey', {
@@ -275,8 +1794,8 @@ class PackageGenerator:
             'KeyPath': reg['key_path'],
           })
 
-    def create_custom_actions(self, product, install_execute_sequence, action):
-        ET.SubElement(product, 'CustomAction', {
+    def create_custom_actions(self, install_execute_sequence, action):
+        custom_action = ET.Element('CustomAction', {
             'Id': action['id'],
             'Directory': action.get('directory', 'TARGETDIR'),
             'ExeCommand': action['exe_command'],
@@ -289,15 +1808,136 @@ class PackageGenerator:
             'Action': action['id'],
             key: action[key.lower()],
         })
-
-    def scan_feature(self, top_feature, installdir, depth, feature):
+        return custom_action
+
+    def plan_media(self):
+        # By default everything goes in a single cabinet. If any part sets
+        # a compression level or there is a size limit, every part gets
+        # cabinets of its own, split whenever the limit would be exceeded,
+        # which allows WiX to build them in parallel.
+        self.media = []
+        self.component_disks = {}
+        self.media_hashes = {}
+        self.part_disks = {}
+        if self.cab_cache is None and self.max_cab_size is None and not any('compression' in f for f in self.parts):
+            self.media.append(('1', self.basename + '.cab', None))
+            return
+        for f in self.parts:
+            sd = f['staged_dir']
+            compression = f.get('compression')
+            cab_size = None
+            components = ((node, comp) for dirpath, node in walk_tree(self.trees[sd], sd)
+                          for comp in self.split_components(node, dirpath))
+            for node, (comp_key, files) in components:
+                size = sum(node.file_info.get(x, FileInfo(0, 0)).size or 0 for x in files)
+                if cab_size is None or (self.max_cab_size is not None and cab_size > 0 and cab_size + size > self.max_cab_size):
+                    disk_id = str(len(self.media) + 1)
+                    cabinet = self.basename + '.cab' if disk_id == '1' else '%s%s.cab' % (self.basename, disk_id)
+                    self.media.append((disk_id, cabinet, compression))
+                    self.media_hashes[disk_id] = hashlib.sha256(('%s %s' % (compression, self.arch)).encode('utf-8'))
+                    cab_size = 0
+                cab_size += size
+                self.component_disks[comp_key] = disk_id
+                self.part_disks.setdefault(sd, []).append((comp_key, disk_id))
+        if not self.media:
+            self.media.append(('1', self.basename + '.cab', None))
+            self.media_hashes['1'] = hashlib.sha256(b'None')
+        if self.need_msvcrt:
+            st = os.stat(self.path(self.redist_path))
+            self.media_hashes['1'].update(('%s %d %d' % (self.redist_path, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+        for f in self.modules:
+            # Built modules are named after their contents.
+            source = self.module_sources[f['id']]
+            st = os.stat(self.path(source)) if 'merge_module' in f else None
+            self.media_hashes['1'].update(('%s %s\n' % (source, st and (st.st_size, st.st_mtime_ns))).encode('utf-8'))
+
+    def write_media(self):
+        self.cabinets = []
+        for disk_id, cabinet, compression in self.media:
+            if self.cab_cache is not None:
+                cabinet = 'cab%s.cab' % self.media_hashes[disk_id].hexdigest()[:32]
+            self.cabinets.append(cabinet)
+            media_attrs = {
+                'Id': disk_id,
+                'Cabinet': cabinet,
+                'EmbedCab': 'yes',
+            }
+            if compression is not None:
+                media_attrs['CompressionLevel'] = compression
+            self.writer.element('Media', media_attrs)
+
+    def find_duplicates(self, staged_dirs=None):
+        # Only files that have the same size as some other file can have
+        # the same contents, so only those get hashed.
+        if staged_dirs is None:
+            staged_dirs = list(dict.fromkeys(f['staged_dir'] for f in self.parts))
+        by_size = {}
+        for sd in staged_dirs:
+            for dirpath, node in self.trees[sd].items():
+                for f in node.files:
+                    info = node.file_info.get(f)
+                    if info is None or not info.size:
+                        continue
+                    by_size.setdefault(info.size, []).append((os.path.join(dirpath, f), info))
+        candidates = [c for files in by_size.values() if len(files) > 1 for c in files]
+        self.hash_files(candidates)
+        self.content_keys = {p: self.file_hashes[p] for p, _ in candidates}
+        self.mandatory_parts = {}
+        for f in self.parts:
+            self.mandatory_parts[f['staged_dir']] = f.get('absent', 'ab') == 'disallow'
+
+    def hash_files(self, files):
+        # Files are (path, FileInfo) pairs. Already hashed files are skipped.
+        files = [c for c in files if c[0] not in self.file_hashes]
+        with ThreadPoolExecutor(self.scan_workers) as pool:
+            self.file_hashes.update(zip([p for p, _ in files], pool.map(lambda c: self.content_hash(*c), files)))
+
+    def write_manifest(self):
+        # What ended up in the installer and where, for tools that need to
+        # know the contents of the package without opening it.
+        part_ids = {}
+        for f in self.parts:
+            part_ids.setdefault(f['staged_dir'], f['id'])
+        entries = []
+        for sd in part_ids:
+            for dirpath, node in self.trees[sd].items():
+                for fname in node.files:
+                    source = os.path.join(dirpath, fname)
+                    component_id, file_id = self.file_ids[source]
+                    entries.append({'path': source[len(sd) + 1:].replace('/', '\\'),
+                                    'part': part_ids[sd],
+                                    'size': node.file_info.get(fname, FileInfo(None, None)).size,
+                                    'sha256': self.file_hashes[source],
+                                    'component': component_id,
+                                    'file_id': file_id,
+                                    })
+        entries.sort(key=lambda e: (e['part'], e['path']))
+        manifest = {'package': os.path.basename(self.final_output),
+                    'version': self.version,
+                    'arch': self.arch,
+                    'product_code': self.guid,
+                    'upgrade_code': self.upgrade_guid,
+                    'installdir': self.installdir,
+                    'files': entries,
+                    }
+        with open(self.manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    def find_copy_source(self, source, staging_dir):
+        # A duplicate file is installed by copying an earlier file with the
+        # same contents. That only works if the original is always installed
+        # when the copy is, i.e. it is in the same part or a mandatory one.
+        key = self.content_keys.get(source)
+        if key is None:
+            return None
+        for sd, file_id in self.content_originals.get(key, []):
+            if sd == staging_dir or self.mandatory_parts[sd]:
+                return file_id
+        return None
+
+    def scan_feature(self, feature):
         for sd in [feature['staged_dir']]:
-            if '/' in sd or '\\' in sd:
-                sys.exit('Staged_dir %s must not have a path segment.' % sd)
-            nodes = {}
-            for root, dirs, files in os.walk(sd):
-                cur_node = Node(dirs, files)
-                nodes[root] = cur_node
+            nodes = self.trees[sd]
             fdict = {
                 'Id': feature['id'],
                 'Title': feature['title'],
@@ -309,33 +1949,291 @@ class PackageGenerator:
             self.feature_properties[sd] = fdict
 
             self.feature_components[sd] = []
-            self.create_xml(nodes, sd, installdir, sd)
-            self.build_features(nodes, top_feature, sd)
-
-    def build_features(self, nodes, top_feature, staging_dir):
-        feature = ET.SubElement(top_feature, 'Feature',  self.feature_properties[staging_dir])
+            self.create_xml(nodes, sd, sd)
+            self.report.add_part(feature['id'], nodes, len(self.feature_components[sd]))
+
+    def fragment_file(self, feature):
+        return os.path.join(self.outdir, '%s-%s.wxs' % (self.wxs_base, feature['id']))
+
+    def fragment_fingerprint(self, feature, generator, environment):
+        h = Fingerprint()
+        add = h.add
+        sd = feature['staged_dir']
+        add(generator, platform.system(), self.progfile_dir, self.upgrade_guid, environment)
+        add(json.dumps(feature, sort_keys=True))
+        add(self.deterministic_ids, self.deduplicate, self.cab_cache is not None, self.manifest)
+        add(self.component_strategy, self.max_component_files, self.max_component_size)
+        add(self.part_disks.get(sd, []))
+        self.hash_tree(add, self.trees[sd])
+        return h.hexdigest()
+
+    def write_fragments(self):
+        # Every part goes in a WXS file of its own, which is only rewritten
+        # if something that affects it has changed. What the main document
+        # needs to know about a part is stored next to it in a JSON file.
+        generator = hash_file(os.path.abspath(__file__))
+        # The PATH entry goes in the first component of the package.
+        env_part = None
+        if platform.system() == "Windows":
+            env_part = next((f['id'] for f in self.parts
+                             if any(n.files for n in self.trees[f['staged_dir']].values())), None)
+        self.fragment_files = []
+        states = {}
+        stale = []
+        for f in self.parts:
+            fname = self.fragment_file(f)
+            self.fragment_files.append(fname)
+            fingerprint = self.fragment_fingerprint(f, generator, f['id'] == env_part)
+            if os.path.exists(fname) and os.path.exists(fname + '.json'):
+                with open(fname + '.json') as sf:
+                    state = json.load(sf)
+                if state['fingerprint'] == fingerprint:
+                    states[f['id']] = state
+                    continue
+            stale.append((f, fingerprint))
+        if self.deduplicate and stale:
+            with self.report.phase('deduplicate'):
+                self.find_duplicates([f['staged_dir'] for f, _ in stale])
+        # Reused parts have to be accounted for as if they were generated.
+        for f in self.parts:
+            if f['id'] in states:
+                state = states[f['id']]
+                self.dedup_files += state['dedup_files']
+                self.dedup_bytes += state['dedup_bytes']
+                self.file_ids.update((source, tuple(ids)) for source, ids in state['files'].items())
+                self.report.add_part(f['id'], self.trees[f['staged_dir']], state['components'])
+        self.report.set('fragments', {'generated': len(stale), 'reused': len(states)})
+        for f, fingerprint in stale:
+            states[f['id']] = self.write_fragment(f, fingerprint, f['id'] == env_part)
+        for f in self.parts:
+            for disk_id, digest in states[f['id']]['media'].items():
+                self.media_hashes[disk_id].update(digest.encode('utf-8'))
+
+    def write_fragment(self, feature, fingerprint, environment):
+        sd = feature['staged_dir']
+        fname = self.fragment_file(feature)
+        main_writer = self.writer
+        main_hashes = self.media_hashes
+        main_file_ids = self.file_ids
+        self.file_ids = {}
+        dedup_files = self.dedup_files
+        dedup_bytes = self.dedup_bytes
+        self.media_hashes = {disk_id: hashlib.sha256() for _, disk_id in self.part_disks.get(sd, [])}
+        # IDs are numbered per part so that they do not depend on what
+        # is in the other parts. Files are only deduplicated within a part
+        # for the same reason.
+        self.idnum = 0
+        self.component_num = 0
+        self.id_prefix = feature['id'] + '_'
+        self.content_originals = {}
+        self.need_environment = environment
+        with open(fname, 'w', encoding='utf-8') as ofile:
+            self.writer = WxsWriter(ofile)
+            self.writer.start('Wix', {'xmlns': 'http://wixtoolset.org/schemas/v4/wxs'})
+            self.writer.start('Fragment')
+            self.writer.start('DirectoryRef', {'Id': 'INSTALLDIR'})
+            self.scan_feature(feature)
+            self.writer.end() # DirectoryRef
+            self.build_features(sd)
+            self.writer.end() # Fragment
+            self.writer.end() # Wix
+            self.writer.close()
+        state = {'fingerprint': fingerprint,
+                 'components': len(self.feature_components[sd]),
+                 'media': {disk_id: h.hexdigest() for disk_id, h in self.media_hashes.items()},
+                 'dedup_files': self.dedup_files - dedup_files,
+                 'dedup_bytes': self.dedup_bytes - dedup_bytes,
+                 'files': self.file_ids,
+                 }
+        with open(fname + '.json', 'w') as sf:
+            json.dump(state, sf)
+        self.writer = main_writer
+        self.media_hashes = main_hashes
+        main_file_ids.update(self.file_ids)
+        self.file_ids = main_file_ids
+        return state
+
+    def module_path(self, feature, arch=None):
+        module = feature['merge_module']
+        if isinstance(module, dict):
+            return module[str(arch if arch is not None else self.arch)]
+        return module
+
+    def module_fingerprint(self, feature):
+        # Only what goes in the module itself, so that products that ship
+        # the same files share the module.
+        h = Fingerprint()
+        add = h.add
+        add(hash_file(os.path.abspath(__file__)), platform.system(), self.arch)
+        add(json.dumps({k: feature.get(k) for k in ('id', 'description', 'include', 'exclude')}, sort_keys=True))
+        add(self.module_version(feature), self.manufacturer)
+        add(self.deterministic_ids, self.component_strategy, self.max_component_files, self.max_component_size)
+        self.hash_tree(add, self.trees[feature['staged_dir']], hash_contents=True)
+        return h.hexdigest()
+
+    def module_version(self, feature):
+        return feature.get('version', self.version)
+
+    def module_output(self, feature):
+        return os.path.join(self.outdir, '%s-%s-%s-%d.msm' % (self.basename, feature['id'],
+                                                               self.module_version(feature), self.arch))
+
+    def module_source(self, feature):
+        # Returns the merge module to use for the part. Modules built from
+        # staged files are cached by their contents and only generated if
+        # they are not in the cache yet.
+        if 'merge_module' in feature:
+            return self.module_path(feature)
+        msm = os.path.join(self.module_cache, self.module_fingerprint(feature) + '.msm')
+        if not os.path.exists(msm):
+            wxs = os.path.join(self.outdir, '%s-%s.module.wxs' % (self.wxs_base, feature['id']))
+            self.pending_modules.append((feature, wxs, msm))
+        return msm
+
+    def write_module(self, feature, fname):
+        sd = feature['staged_dir']
+        saved = (self.writer, self.idnum, self.component_num, self.id_prefix, self.need_environment, self.uuid_namespace)
+        self.idnum = 0
+        self.component_num = 0
+        self.id_prefix = feature['id'] + '_'
+        self.need_environment = False
+        self.uuid_namespace = uuid.uuid5(MODULE_NAMESPACE, feature['id'])
+        self.feature_components[sd] = []
+        with open(fname, 'w', encoding='utf-8') as ofile:
+            w = self.writer = WxsWriter(ofile)
+            w.start('Wix', {'xmlns': 'http://wixtoolset.org/schemas/v4/wxs'})
+            w.start('Module', {
+                'Id': feature['id'],
+                'Language': '0',
+                'Version': self.module_version(feature),
+            })
+            w.element('SummaryInformation', {
+                'Description': feature['description'],
+                'Manufacturer': self.manufacturer,
+            })
+            # Files go where the module is merged in the product.
+            w.start('Directory', {'Id': 'MergeRedirectFolder'})
+            self.create_xml(self.trees[sd], sd, sd, 'MergeRedirectFolder')
+            w.end() # Directory
+            w.end() # Module
+            w.end() # Wix
+            w.close()
+        self.report.add_part(feature['id'], self.trees[sd], len(self.feature_components[sd]))
+        self.writer, self.idnum, self.component_num, self.id_prefix, self.need_environment, self.uuid_namespace = saved
+
+    def build_modules(self):
+        os.makedirs(self.module_cache, exist_ok=True)
+        for _, wxs, msm in self.pending_modules:
+            # Other builds may use the cache at the same time, so the module
+            # only appears there once it is complete.
+            tmpfile = '%s.%d.tmp.msm' % (msm[:-4], os.getpid())
+            self.backend.build_module(self, wxs, tmpfile)
+            os.replace(tmpfile, msm)
+        self.report.set('modules', {'built': len(self.pending_modules),
+                                    'cached': sum(1 for f in self.modules if 'staged_dir' in f) - len(self.pending_modules)})
+        self.pending_modules = []
+        # A copy of each built module goes next to the installer so that
+        # other definitions can use it with merge_module.
+        for f in self.modules:
+            if 'staged_dir' in f:
+                shutil.copyfile(self.module_sources[f['id']], self.module_output(f))
+
+    def build_features(self, staging_dir):
+        self.writer.start('Feature',  self.feature_properties[staging_dir])
         for component_id in self.feature_components[staging_dir]:
-            ET.SubElement(feature, 'ComponentRef', {
+            self.writer.element('ComponentRef', {
                 'Id': component_id,
             })
+        self.writer.end()
+
+    def stable_uuid(self, key):
+        # Keyed on the install location so that the same path always gets
+        # the same value and an unrelated change does not renumber it.
+        key = self.progfile_dir + '/' + key.replace('\\', '/')
+        return uuid.uuid5(self.uuid_namespace, key)
+
+    def install_key(self, path, staging_dir):
+        # Where the part installs the path, so that renaming the
+        # staged_dir or switching to an install manifest keeps the IDs.
+        return self.id_roots[staging_dir] + ':' + path[len(staging_dir):].replace('\\', '/').lstrip('/')
+
+    def component_guid(self, key):
+        if self.deterministic_ids:
+            return str(self.stable_uuid('component:' + key)).upper()
+        return gen_guid()
 
     def path_to_id(self, pathname):
         #return re.sub(r'[^a-zA-Z0-9_.]', '_', str(pathname))[-72:]
-        idstr = f'pathid{self.idnum}'
+        if self.deterministic_ids:
+            return 'pathid' + self.stable_uuid('path:' + pathname).hex
+        idstr = f'pathid{self.id_prefix}{self.idnum}'
         self.idnum += 1
         return idstr
 
-    def create_xml(self, nodes, current_dir, parent_xml_node, staging_dir):
+    def component_id(self, key):
+        if self.deterministic_ids:
+            return 'ApplicationFiles' + self.stable_uuid('component:' + key).hex
+        return 'ApplicationFiles%s%d' % (self.id_prefix, self.component_num)
+
+    def split_components(self, node, current_dir):
+        # Decides which files of one directory go in which component.
+        # Returns a list of (component key, file names) pairs.
+        if not node.files:
+            return []
+        if self.component_strategy == 'file':
+            return [(os.path.join(current_dir, f), [f]) for f in node.files]
+        if self.max_component_files is None and self.max_component_size is None:
+            return [(current_dir, node.files)]
+        shards = []
+        cur_files = []
+        cur_size = 0
+        for f in node.files:
+            size = node.file_info.get(f, FileInfo(0, 0)).size or 0
+            if cur_files and ((self.max_component_files is not None and len(cur_files) >= self.max_component_files) or
+                              (self.max_component_size is not None and cur_size + size > self.max_component_size)):
+                shards.append(cur_files)
+                cur_files = []
+                cur_size = 0
+            cur_files.append(f)
+            cur_size += size
+        shards.append(cur_files)
+        # The first shard has the same key as an unsplit directory, the
+        # others are keyed by their first file so that GUIDs stay stable
+        # for as long as the shard boundaries do.
+        return [(current_dir if i == 0 else current_dir + '|' + files[0], files) for i, files in enumerate(shards)]
+
+    def choose_key_path(self, files, copy_sources):
+        # Versioned files are the best key paths, otherwise take the first
+        # file that is actually installed by this component.
+        candidates = [f for f, copy_source in zip(files, copy_sources) if copy_source is None]
+        for f in candidates:
+            if os.path.splitext(f)[1].lower() in VERSIONED_EXTENSIONS:
+                return f
+        return candidates[0] if candidates else None
+
+    def create_xml(self, nodes, current_dir, staging_dir, dir_id='INSTALLDIR'):
+        w = self.writer
         cur_node = nodes[current_dir]
-        if cur_node.files:
-            component_id = 'ApplicationFiles%d' % self.component_num
-            comp_xml_node = ET.SubElement(parent_xml_node, 'Component', {
+        for comp_key, files in self.split_components(cur_node, current_dir):
+            component_id = self.component_id(self.install_key(comp_key, staging_dir))
+            copy_sources = [self.find_copy_source(os.path.join(current_dir, f), staging_dir) for f in files]
+            comp_attrs = {
                 'Id': component_id,
-                'Guid': gen_guid(),
-            })
+                'Guid': self.component_guid(self.install_key(comp_key, staging_dir)),
+            }
+            key_path = None
+            if None not in copy_sources:
+                # No File elements to use as the key path.
+                comp_attrs['KeyPath'] = 'yes'
+            elif self.explicit_key_paths:
+                key_path = self.choose_key_path(files, copy_sources)
+            if comp_key in self.component_disks:
+                comp_attrs['DiskId'] = self.component_disks[comp_key]
+            w.start('Component', comp_attrs)
             self.feature_components[staging_dir].append(component_id)
-            if platform.system() == "Windows" and self.component_num == 0:
-                ET.SubElement(comp_xml_node, 'Environment', {
+            if self.need_environment:
+                self.need_environment = False
+                w.element('Environment', {
                     'Id': 'Environment',
                     'Name': 'PATH',
                     'Part': 'last',
@@ -344,24 +2242,50 @@ class PackageGenerator:
                     'Value': '[INSTALLDIR]',
                 })
             self.component_num += 1
-            for f in cur_node.files:
-                file_id = self.path_to_id(os.path.join(current_dir, f))
-                ET.SubElement(comp_xml_node, 'File', {
+            for f, copy_source in zip(files, copy_sources):
+                source = os.path.join(current_dir, f)
+                file_id = self.path_to_id(self.install_key(source, staging_dir))
+                if copy_source is not None:
+                    w.element('CopyFile', {
+                        'Id': file_id,
+                        'FileId': copy_source,
+                        'DestinationDirectory': dir_id,
+                        'DestinationName': f,
+                    })
+                    self.dedup_files += 1
+                    self.dedup_bytes += cur_node.file_info[f].size
+                    self.file_ids[source] = (component_id, file_id)
+                    continue
+                file_attrs = {
                     'Id': file_id,
                     'Name': f,
-                    'Source': os.path.join(current_dir, f),
-                })
+                    'Source': cur_node.sources.get(f, source),
+                }
+                if f == key_path:
+                    file_attrs['KeyPath'] = 'yes'
+                w.element('File', file_attrs)
+                self.file_ids[source] = (component_id, file_id)
+                if self.cab_cache is not None and 'DiskId' in comp_attrs:
+                    # Use the contents of the file if they are known.
+                    info = cur_node.file_info.get(f, FileInfo(None, None))
+                    version = self.file_hashes.get(source, info.mtime_ns)
+                    self.media_hashes[comp_attrs['DiskId']].update(
+                        ('%s %s %s %s\n' % (file_id, source, info.size, version)).encode('utf-8'))
+                if source in self.content_keys:
+                    self.content_originals.setdefault(self.content_keys[source], []).append((staging_dir, file_id))
+            w.end()
 
         for dirname in cur_node.dirs:
-            dir_id = self.path_to_id(os.path.join(current_dir, dirname))
-            dir_node = ET.SubElement(parent_xml_node, 'Directory', {
+            dir_id = self.path_to_id(self.install_key(os.path.join(current_dir, dirname), staging_dir))
+            w.start('Directory', {
                 'Id': dir_id,
                 'Name': dirname,
             })
-            self.create_xml(nodes, os.path.join(current_dir, dirname), dir_node, staging_dir)
+            self.create_xml(nodes, os.path.join(current_dir, dirname), staging_dir, dir_id)
+            w.end()
 
-    def create_licenseless_dialog_entries(self, product_element):
-        ui = ET.SubElement(product_element, 'UI', {
+    def create_licenseless_dialog_entries(self):
+        ui = ET.Element('UI', {
             'Id': 'WixUI_FeatureTree'
         })
 
@@ -558,35 +2482,335 @@ class PackageGenerator:
 
         pub_maint_type_back.text = '1'
 
-        ET.SubElement(product_element, 'UIRef', {
+        self.writer.write_tree(ui)
+        self.writer.element('UIRef', {
             'Id': 'WixUI_Common',
         })
 
     def build_package(self):
-        if shutil.which('wix') is None:
-            print("ERROR: This script requires WIX 4")
+        if shutil.which(self.backend.tool) is None:
+            print("ERROR: This script requires %s" % self.backend.requires)
             sys.exit(1)
-        cmd_arr = ['wix',
-                   'build',
-                   '-ext', 'WixToolset.UI.wixext',
-                   #'-cultures:en-us',
-                   ]
-        if self.license_file:
-            cmd_arr += ['-bindvariable', 'WixUILicenseRtf=' + self.license_file]
-        cmd_arr += ['-arch', 'x64',
-                    '-out', self.final_output,
-                    self.main_xml]
-        subprocess.check_call(cmd_arr)
+        if self.modules:
+            with self.report.phase('%s_modules' % self.backend.name):
+                self.build_modules()
+        with self.report.phase('%s_build' % self.backend.name):
+            self.backend.build_package(self)
+
+    def find_baseline(self):
+        # The latest earlier version of the same package and architecture.
+        def version_key(version):
+            return tuple(int(x) for x in version.split('.'))
+        pattern = '%s-*-%d.msi.manifest.json' % (glob_escape(self.basename), self.arch)
+        baseline = None
+        for fname in glob(os.path.join(self.patch_from, pattern)):
+            with open(fname) as f:
+                manifest = json.load(f)
+            if version_key(manifest['version']) >= version_key(self.version):
+                continue
+            if baseline is None or version_key(manifest['version']) > version_key(baseline[1]['version']):
+                baseline = (fname, manifest)
+        if baseline is None:
+            sys.exit('No build of %s older than version %s found in %s.' % (self.basename, self.version, self.patch_from))
+        return baseline
+
+    def patch_components(self, baseline, current):
+        # Only components that have new or changed files go in the patch.
+        # Windows Installer can not remove files from a component with a
+        # patch, so those changes need a full installer.
+        old_files = {e['path'].lower(): e for e in baseline['files']}
+        new_files = {e['path'].lower(): e for e in current['files']}
+        errors = []
+        for key, old in old_files.items():
+            if key not in new_files:
+                errors.append('%s has been removed.' % old['path'])
+            elif new_files[key]['component'] != old['component']:
+                errors.append('%s has moved to another component.' % old['path'])
+        if errors:
+            sys.exit(format_errors('A patch from version %s' % baseline['version'], errors[:10] +
+                                   ['A full installer is needed for these changes.']))
+        changed = set()
+        for key, new in new_files.items():
+            old = old_files.get(key)
+            if old is None or old['sha256'] != new['sha256'] or old['size'] != new['size']:
+                changed.add(new['component'])
+        return sorted(changed)
+
+    def build_patch(self):
+        baseline_manifest, baseline = self.find_baseline()
+        if baseline['product_code'] != self.guid:
+            sys.exit('Version %s has a different product code, a patch can not be made from it.' % baseline['version'])
+        baseline_pdb = baseline_manifest[:-len('.msi.manifest.json')] + '.wixpdb'
+        if not os.path.exists(baseline_pdb):
+            sys.exit('%s is needed for making a patch but it does not exist.' % baseline_pdb)
+        with open(self.manifest_file) as f:
+            current = json.load(f)
+        components = self.patch_components(baseline, current)
+        self.report.set('patch', {'baseline': baseline['version'], 'components': len(components)})
+        if not components:
+            print('Nothing has changed since version %s, no patch made.' % baseline['version'])
+            return
+        with open(self.patch_xml, 'w', encoding='utf-8') as ofile:
+            w = WxsWriter(ofile)
+            w.start('Wix', {'xmlns': 'http://wixtoolset.org/schemas/v4/wxs'})
+            w.start('Patch', {
+                'AllowRemoval': 'yes',
+                'Classification': 'Update',
+                'DisplayName': '%s %s' % (self.name, self.version),
+                'Description': 'Update of %s from %s to %s' % (self.name, baseline['version'], self.version),
+                'Manufacturer': self.manufacturer,
+            })
+            # Must be above the disk IDs of the installers.
+            w.start('Media', {'Id': '5000', 'Cabinet': 'patch.cab'})
+            w.element('PatchBaseline', {
+                'Id': 'Baseline',
+                'BaselineFile': os.path.abspath(baseline_pdb),
+                'UpdateFile': self.pdb_file,
+            })
+            w.end() # Media
+            w.start('PatchFamily', {
+                'Id': 'Update',
+                'Version': self.version,
+                'Supersede': 'yes',
+            })
+            for component_id in components:
+                w.element('ComponentRef', {'Id': component_id})
+            w.end() # PatchFamily
+            w.end() # Patch
+            w.end() # Wix
+            w.close()
+        print('Patch from version %s updates %d components.' % (baseline['version'], len(components)))
+        with self.report.phase('%s_patch' % self.backend.name):
+            self.backend.build_patch(self)
+
+def print_deduplication(generators):
+    # Every architecture removes the same files.
+    for g in generators:
+        if g.dedup_files:
+            print('Deduplicated %d files, saving %d bytes.' % (g.dedup_files, g.dedup_bytes))
+            return
+
+def build_definition(jsonfile, force=False, hash_contents=False, **gen_args):
+    p = PackageGenerator(jsonfile, **gen_args)
+    p.check()
+    # The staged trees are scanned once and shared by all architectures.
+    generators = [p] + [PackageGenerator(jsonfile, arch=arch, inventory=p.trees, **gen_args) for arch in p.archs[1:]]
+    for g in generators[1:]:
+        # Shares the file hashes, only the first one saves the index.
+        g.index = p.index
+    to_build = []
+    for g in generators:
+        with g.report.phase('fingerprint'):
+            fingerprint = g.fingerprint(hash_contents)
+        if not force and g.is_up_to_date(fingerprint):
+            print('%s is up to date.' % g.final_output)
+            # The fingerprint is only written once the patch is done, but
+            # the patch may have been deleted since.
+            if g.patch_from is not None and not os.path.exists(g.patch_file):
+                g.build_patch()
+            continue
+        if os.path.exists(g.fingerprint_file):
+            os.unlink(g.fingerprint_file)
+        g.generate_files()
+        to_build.append((g, fingerprint))
+    print_deduplication([g for g, _ in to_build])
+    p.save_index()
+    # WiX runs are independent of each other, so all architectures are
+    # built at the same time.
+    with ThreadPoolExecutor(max(len(to_build), 1)) as pool:
+        builds = [(g, fingerprint, pool.submit(g.build_package)) for g, fingerprint in to_build]
+    error = None
+    for g, fingerprint, build in builds:
+        try:
+            build.result()
+            if g.patch_from is not None:
+                g.build_patch()
+        except (subprocess.CalledProcessError, SystemExit) as e:
+            error = error or e
+            continue
+        g.write_fingerprint(fingerprint)
+        if g.report.enabled or g.report.hooks:
+            g.finish_report()
+    if error is not None:
+        raise error
+
+def watch_definition(jsonfile, build=False, delay=0.5, **gen_args):
+    # Keeps the staged trees in memory and generates the package again,
+    # building it as well if build is set, whenever they change. Only the
+    # changed directories are listed again.
+    p = PackageGenerator(jsonfile, **gen_args)
+    p.check()
+    generators = [p] + [PackageGenerator(jsonfile, arch=arch, inventory=p.trees, **gen_args) for arch in p.archs[1:]]
+    p.save_index()
+    # Install manifests are read only once.
+    watcher = tree_watcher(p.basedir, p.filters, [sd for sd in p.trees if sd not in p.manifest_parts])
+    try:
+        while True:
+            start = time.perf_counter()
+            for g in generators:
+                g.trees = p.trees
+                g.generate_files()
+                if not build:
+                    continue
+                fingerprint = g.fingerprint()
+                if os.path.exists(g.fingerprint_file):
+                    os.unlink(g.fingerprint_file)
+                try:
+                    g.build_package()
+                except subprocess.CalledProcessError as e:
+                    print('Building %s failed: %s' % (g.final_output, e))
+                    continue
+                g.write_fingerprint(fingerprint)
+            print_deduplication(generators)
+            print('%s %s in %.0f ms.' % ('Built' if build else 'Generated', ', '.join(os.path.basename(g.main_xml) for g in generators),
+                                       1000 * (time.perf_counter() - start)))
+            print('Watching %d directories for changes (%s), press Ctrl+C to stop.'
+                  % (sum(len(p.trees[root]) for root in watcher.roots), watcher.name))
+            while True:
+                trees = watcher.wait(p.trees, delay)
+                for root, nodes in trees.items():
+                    # Hashes of changed files are out of date.
+                    changes = tree_changes(p.trees[root], nodes)
+                    for path in changes.modified + changes.removed:
+                        for g in generators:
+                            g.file_hashes.pop(path, None)
+                p.trees = trees
+                errors = p.check_inventory()
+                if not errors:
+                    break
+                print(format_errors(p.definition_name, errors))
+    except KeyboardInterrupt:
+        pass
+
+def check_definitions(jsonfiles, **gen_args):
+    # Validates definitions without generating or building anything.
+    ok = True
+    for jsonfile in jsonfiles:
+        try:
+            p = PackageGenerator(jsonfile, **gen_args)
+            errors = p.validate()
+            message = format_errors(jsonfile, errors) if errors else '%s: OK' % jsonfile
+        except SystemExit as e:
+            errors = [e.code]
+            message = str(e.code)
+        except (OSError, ValueError) as e:
+            errors = [e]
+            message = '%s: %s' % (jsonfile, e)
+        print(message)
+        ok = ok and not errors
+    return ok
+
+def batch_worker(jsonfile, force, hash_contents, gen_args):
+    # Runs in a pool process. Errors are turned into an exit code so that
+    # one broken package does not take the rest of the batch down.
+    start = time.perf_counter()
+    returncode = 0
+    message = ''
+    try:
+        build_definition(jsonfile, force, hash_contents, **gen_args)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        else:
+            returncode = 1
+            message = str(e.code)
+    except subprocess.CalledProcessError as e:
+        returncode = e.returncode
+        message = 'Command %s failed.' % e.cmd[0]
+    except Exception as e:
+        returncode = 1
+        message = '%s: %s' % (type(e).__name__, e)
+    return returncode, time.perf_counter() - start, message
+
+def read_batch_file(batchfile):
+    basedir = os.path.dirname(batchfile)
+    jsonfiles = []
+    with open(batchfile) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                jsonfiles.append(os.path.join(basedir, line))
+    return jsonfiles
+
+def run_batch(jsonfiles, jobs=None, force=False, hash_contents=False, **gen_args):
+    start = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(batch_worker, j, force, hash_contents, gen_args) for j in jsonfiles]
+        results = [f.result() for f in futures]
+    total = time.perf_counter() - start
+    namelen = max([len('Package')] + [len(os.path.relpath(j)) for j in jsonfiles])
+    print('\n%-*s  %9s  %s' % (namelen, 'Package', 'Time', 'Exit code'))
+    for j, (returncode, duration, message) in zip(jsonfiles, results):
+        line = '%-*s  %8.1fs  %d' % (namelen, os.path.relpath(j), duration, returncode)
+        if message:
+            line += '  ' + message
+        print(line)
+    failed = len([r for r in results if r[0] != 0])
+    print('\n%d packages, %d failed, %.1fs total.' % (len(results), failed, total))
+    return failed == 0
 
 def run(args):
-    if len(args) != 1:
-        sys.exit('createmsi.py <msi definition json>')
-    jsonfile = args[0]
-    if '/' in jsonfile or '\\' in jsonfile:
-        sys.exit('Input file %s must not contain a path segment.' % jsonfile)
-    p = PackageGenerator(jsonfile)
-    p.generate_files()
-    p.build_package()
+    parser = argparse.ArgumentParser(prog='createmsi.py')
+    parser.add_argument('jsonfiles', metavar='jsonfile', nargs='*', help='msi definition json')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='build all definitions listed in FILE, one per line')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of packages to build in parallel in batch mode')
+    parser.add_argument('-o', '--outdir',
+                        help='directory for the generated files (default: the directory of the definition)')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the definitions and staged files for errors')
+    parser.add_argument('--force', action='store_true',
+                        help='build even if the inputs have not changed since the last build')
+    parser.add_argument('--hash-contents', action='store_true',
+                        help='compare file contents instead of sizes and mtimes to detect changes')
+    parser.add_argument('--report', action='store_true',
+                        help='write timings and sizes of the build to <msi>.report.json')
+    parser.add_argument('--index', action='store_true',
+                        help='keep an index of the staged trees in <name_base>.index.sqlite to speed up rescans')
+    parser.add_argument('--verify-index', action='store_true',
+                        help='like --index, but also check the files in unmodified directories for changes')
+    parser.add_argument('--patch-from', metavar='DIR',
+                        help='also make a patch from the latest earlier build found in DIR')
+    parser.add_argument('--watch', nargs='?', const='generate', choices=('generate', 'build'),
+                        help='keep running and generate (or also build) the package again whenever the staged files change')
+    parser.add_argument('--debounce', metavar='SECONDS', type=float, default=0.5,
+                        help='in watch mode, wait until nothing has changed for this long (default: %(default)s)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='tool to build the package with (default: wix, or wixl if only it is installed)')
+    parser.add_argument('--cab-cache', metavar='DIR',
+                        help='keep built cabinets in DIR and reuse them in later builds')
+    parser.add_argument('--cab-cache-size', metavar='MB', type=int, default=10*1024,
+                        help='maximum size of the cabinet cache (default: %(default)s)')
+    options = parser.parse_args(args)
+    gen_args = {'outdir': options.outdir,
+                'cab_cache': options.cab_cache,
+                'cab_cache_size': options.cab_cache_size,
+                'report': options.report,
+                'tree_index': options.index,
+                'verify_index': options.verify_index,
+                'patch_from': options.patch_from,
+                'backend': options.backend,
+                }
+    jsonfiles = options.jsonfiles
+    if options.batch:
+        jsonfiles += read_batch_file(options.batch)
+    if not jsonfiles:
+        parser.error('no msi definition json given')
+    if options.check:
+        if not check_definitions(jsonfiles, **gen_args):
+            sys.exit(1)
+        return
+    if options.watch:
+        if len(jsonfiles) > 1:
+            parser.error('only one definition can be watched at a time')
+        watch_definition(jsonfiles[0], options.watch == 'build', options.debounce, **gen_args)
+        return
+    if len(jsonfiles) > 1 or options.batch:
+        if not run_batch(jsonfiles, options.jobs, options.force, options.hash_contents, **gen_args):
+            sys.exit(1)
+        return
+    build_definition(jsonfiles[0], options.force, options.hash_contents, **gen_args)
 
 if __name__ == '__main__':
     run(sys.argv[1:])
@@ -0,0 +1,2 @@
+@ECHO OFF
+ECHO I am an executable.
@@ -104,15 +104,21 @@ if __name__ == '__main__':
                 ('productguid', 'productguid.json'),
                 ('UIgraphics', 'uigraphics.json'),
                 #('withoutlicense', 'withoutlicense.json')
-                ('customactions', 'customactions.json')
+                ('customactions', 'customactions.json'),
+                ('deduplicate', 'deduplicate.json'),
+                ('components', 'components.json'),
+                ('components', 'perfile.json'),
+                ('partfragments', 'partfragments.json'),
+                ('mergemodule', 'runtime.json'),
+                ('installmanifest', 'installmanifest.json'),
     ]
+    # These use merge modules built by the ones above.
+    module_testdirs = [('mergemodule', 'prebuilt.json')]
 
     if shutil.which('wix') is None:
         install_wix()
     build_binaries()
-    for d in testdirs:
-        print("\n\nTest:", d[0], '\n')
-        os.chdir(d[0])
-        createmsi.run([d[1]]) # In case of error this throws a sys.exit.
-        os.chdir('..')
+    for dirs in (testdirs, module_testdirs):
+        if not createmsi.run_batch([os.path.join(*d) for d in dirs], force=True):
+            sys.exit('Some tests failed.')
     print('All tests pass.')
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# Copyright 2017-2023 Jussi Pakkanen et al
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Unit tests for the parts of createmsi that do not need WiX. Run with
+# python3 test_createmsi.py, python3 -m unittest test_createmsi or
+# pytest test_createmsi.py in the repository root. The example
+# packages are built by run_tests.py.
+
+import os, sys, json, tempfile, time, unittest
+
+# The repository root has a test directory called msvcrt, which shadows
+# the Windows-only module of the same name that subprocess probes for.
+# Import it with the root taken off the path.
+root = os.path.dirname(os.path.abspath(__file__))
+path = sys.path
+sys.path = [p for p in path if os.path.abspath(p or os.curdir) != root]
+import subprocess
+sys.path = path
+import xml.etree.ElementTree as ET
+import createmsi
+
+def definition(**kwargs):
+    d = {
+        'upgrade_guid': '2306069D-456E-4CA5-AA18-94805C18C5DF',
+        'version': '1.0.0',
+        'product_name': 'Test',
+        'manufacturer': 'Test',
+        'name': 'Test',
+        'name_base': 'test',
+        'comments': 'Test',
+        'installdir': 'Test',
+        'parts': [{'id': 'Core', 'title': 'Core', 'description': 'Core', 'staged_dir': 'staging'}],
+    }
+    d.update(kwargs)
+    return d
+
+class GlobTests(unittest.TestCase):
+
+    def excluded(self, patterns, path, is_dir=False):
+        f = createmsi.PathFilter('root', exclude=patterns)
+        return f.exclusion('root/' + path, is_dir) is not None
+
+    def test_name_matches_at_any_depth(self):
+        self.assertTrue(self.excluded(['*.pdb'], 'a.pdb'))
+        self.assertTrue(self.excluded(['*.pdb'], 'lib/sub/a.pdb'))
+        self.assertFalse(self.excluded(['*.pdb'], 'a.pdbx'))
+
+    def test_slash_anchors(self):
+        self.assertTrue(self.excluded(['tests/data'], 'tests/data', True))
+        self.assertFalse(self.excluded(['tests/data'], 'lib/tests/data', True))
+
+    def test_leading_slash_anchors(self):
+        self.assertTrue(self.excluded(['/tests'], 'tests', True))
+        self.assertFalse(self.excluded(['/tests'], 'lib/tests', True))
+
+    def test_trailing_slash_only_matches_directories(self):
+        self.assertTrue(self.excluded(['build/'], 'build', True))
+        self.assertTrue(self.excluded(['build/'], 'sub/build', True))
+        self.assertFalse(self.excluded(['build/'], 'build'))
+        self.assertFalse(self.excluded(['build/'], 'sub/build'))
+
+    def test_stars(self):
+        self.assertFalse(self.excluded(['a/*.txt'], 'a/b/c.txt'))
+        self.assertTrue(self.excluded(['a/**/*.txt'], 'a/b/c.txt'))
+        self.assertTrue(self.excluded(['a/**/*.txt'], 'a/c.txt'))
+        self.assertTrue(self.excluded(['a/**'], 'a/b/c'))
+        self.assertTrue(self.excluded(['file?.dat'], 'file1.dat'))
+        self.assertFalse(self.excluded(['file?.dat'], 'file10.dat'))
+
+    def test_character_classes(self):
+        self.assertTrue(self.excluded(['[ab].txt'], 'a.txt'))
+        self.assertFalse(self.excluded(['[ab].txt'], 'c.txt'))
+        self.assertTrue(self.excluded(['[!ab].txt'], 'c.txt'))
+
+    def test_reason(self):
+        f = createmsi.PathFilter('root', exclude=['*.pdb', 'docs/'])
+        self.assertEqual(f.exclusion('root/x/a.pdb', False), '*.pdb')
+        self.assertEqual(f.exclusion('root/docs', True), 'docs/')
+        self.assertIsNone(f.exclusion('root/docs', False))
+
+    def test_include_only_applies_to_files(self):
+        f = createmsi.PathFilter('root', include=['*.dll'])
+        self.assertIsNone(f.exclusion('root/bin', True))
+        self.assertIsNone(f.exclusion('root/bin/a.dll', False))
+        self.assertEqual(f.exclusion('root/bin/a.txt', False), 'not included')
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.basedir = self.tmpdir.name
+        self.definition = definition()
+        os.makedirs(os.path.join(self.basedir, 'staging', 'sub'))
+        for name in ('a.txt', 'sub/b.txt'):
+            self.write(name, 'old')
+        # The index does not trust anything modified right before a scan.
+        t = time.time() - 3600
+        for path in ('staging/a.txt', 'staging/sub/b.txt', 'staging/sub', 'staging'):
+            os.utime(os.path.join(self.basedir, path), (t, t))
+        self.scan()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, contents):
+        with open(os.path.join(self.basedir, 'staging', name), 'w') as f:
+            f.write(contents)
+
+    def scan(self, verify=False):
+        p = createmsi.PackageGenerator(self.definition, basedir=self.basedir, tree_index=True, verify_index=verify)
+        p.scan()
+        p.save_index()
+        return p
+
+    def size(self, p, path):
+        dirpath, name = os.path.split(os.path.join('staging', path))
+        return p.trees['staging'][dirpath].file_info[name].size
+
+    def test_unchanged_directories_are_trusted(self):
+        path = os.path.join(self.basedir, 'staging', 'sub')
+        st = os.stat(path)
+        self.write('sub/b.txt', 'rewritten')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self.size(self.scan(), 'sub/b.txt'), 3)
+        p = self.scan(verify=True)
+        self.assertEqual(self.size(p, 'sub/b.txt'), 9)
+        self.assertEqual(p.changes['staging'].modified, [os.path.join('staging', 'sub', 'b.txt')])
+
+    def test_new_files_are_found(self):
+        self.write('sub/c.txt', 'new')
+        p = self.scan()
+        self.assertEqual(p.changes['staging'].added, [os.path.join('staging', 'sub', 'c.txt')])
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class InotifyTests(unittest.TestCase):
+
+    def test_falls_back_to_polling(self):
+        with tempfile.TemporaryDirectory() as basedir:
+            os.makedirs(os.path.join(basedir, 'staging'))
+            trees = createmsi.scan_trees(['staging'], basedir=basedir)
+            watcher = createmsi.InotifyWatcher(basedir, {}, ['staging'])
+            class FullLibc:
+                def inotify_add_watch(self, fd, path, mask):
+                    # As when fs.inotify.max_user_watches is reached.
+                    createmsi.ctypes.set_errno(createmsi.errno.ENOSPC)
+                    return -1
+            watcher.libc = FullLibc()
+            watcher.interval = 0.01
+            with open(os.path.join(basedir, 'staging', 'a.txt'), 'w') as f:
+                f.write('new')
+            new_trees = watcher.wait(trees, 0.01)
+            self.assertEqual(watcher.name, 'polling')
+            self.assertEqual(new_trees['staging']['staging'].files, ['a.txt'])
+
+class TreeChangeTests(unittest.TestCase):
+
+    def test_changes(self):
+        old = createmsi.tree_from_paths('root', [
+            ('same.txt', createmsi.FileInfo(1, 1)),
+            ('changed.txt', createmsi.FileInfo(1, 1)),
+            ('removed.txt', createmsi.FileInfo(1, 1)),
+            ('gone/a.txt', createmsi.FileInfo(1, 1)),
+        ])
+        new = createmsi.tree_from_paths('root', [
+            ('same.txt', createmsi.FileInfo(1, 1)),
+            ('changed.txt', createmsi.FileInfo(1, 2)),
+            ('added.txt', createmsi.FileInfo(1, 1)),
+            ('new/b.txt', createmsi.FileInfo(1, 1)),
+        ])
+        changes = createmsi.tree_changes(old, new)
+        self.assertEqual(changes.added, [os.path.join('root', 'added.txt'), os.path.join('root', 'new', 'b.txt')])
+        self.assertEqual(changes.removed, [os.path.join('root', 'gone', 'a.txt'), os.path.join('root', 'removed.txt')])
+        self.assertEqual(changes.modified, [os.path.join('root', 'changed.txt')])
+
+    def test_no_changes(self):
+        nodes = createmsi.tree_from_paths('root', [('a/b.txt', createmsi.FileInfo(1, 1))])
+        changes = createmsi.tree_changes(nodes, dict(nodes))
+        self.assertEqual((changes.added, changes.removed, changes.modified), ([], [], []))
+
+class InstallManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.basedir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, name, contents, prefix=None):
+        with open(os.path.join(self.basedir, name), 'w') as f:
+            f.write(contents if isinstance(contents, str) else json.dumps(contents))
+        return createmsi.read_install_manifest(name, prefix, self.basedir)
+
+    def test_text(self):
+        pairs = self.read('install_manifest.txt', '# comment\n\nbuild/a.exe -> bin/a.exe\nshare/b.txt\n')
+        self.assertEqual(pairs, [('build/a.exe', 'bin/a.exe'), ('share/b.txt', 'share/b.txt')])
+
+    def test_json(self):
+        self.assertEqual(self.read('m.json', {'build/a.exe': 'bin/a.exe'}), [('build/a.exe', 'bin/a.exe')])
+        self.assertEqual(self.read('m.json', [['build/a.exe', 'bin/a.exe']]), [('build/a.exe', 'bin/a.exe')])
+
+    def test_prefix(self):
+        pairs = self.read('m.json', {'build/a.exe': 'c:\\prog\\bin\\a.exe'}, prefix='c:/prog/')
+        self.assertEqual(pairs, [('build/a.exe', 'bin/a.exe')])
+        with self.assertRaises(SystemExit):
+            self.read('m.json', {'build/a.exe': 'd:/other/a.exe'}, prefix='c:/prog')
+
+    def test_destinations_must_be_inside(self):
+        for dest in ('/usr/bin/a.exe', 'c:/prog/a.exe', '../a.exe', 'bin/../../a.exe'):
+            with self.assertRaises(SystemExit):
+                self.read('m.json', {'a.exe': dest})
+
+class CheckDefinitionTests(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual(createmsi.check_definition(definition()), [])
+
+    def test_missing_keys(self):
+        d = definition()
+        del d['version']
+        del d['parts'][0]['title']
+        errors = createmsi.check_definition(d)
+        self.assertEqual(len(errors), 2)
+        self.assertIn('version', errors[0])
+        self.assertIn('title', errors[1])
+
+    def test_bad_values(self):
+        errors = createmsi.check_definition(definition(upgrade_guid='nope', version='1.0.70000', arch=16))
+        self.assertEqual(len(errors), 3)
+
+    def test_parts(self):
+        part = {'id': 'Core', 'title': 'Core', 'description': 'Core'}
+        self.assertTrue(createmsi.check_definition(definition(parts=[part])))
+        self.assertEqual(createmsi.check_definition(definition(parts=[dict(part, install_manifest='m.txt')])), [])
+        self.assertTrue(createmsi.check_definition(definition(parts=[dict(part, install_manifest='m.txt', staged_dir='s')])))
+        self.assertTrue(createmsi.check_definition(definition(parts=[dict(part, staged_dir='s', include=['bin/'])])))
+        self.assertTrue(createmsi.check_definition(definition(parts=[dict(part, staged_dir='s'), dict(part, staged_dir='t')])))
+
+class DeterministicIdTests(unittest.TestCase):
+
+    def ids(self, staged_dir, **kwargs):
+        d = definition(deterministic_ids=True, max_component_files=1, **kwargs)
+        d['parts'][0]['staged_dir'] = staged_dir
+        inventory = {staged_dir: createmsi.tree_from_paths(staged_dir, [('bin/a.exe', None), ('bin/b.dll', None)])}
+        p = createmsi.PackageGenerator(d, basedir='.', inventory=inventory)
+        root = ET.fromstring(p.generate_wxs())
+        return sorted((e.tag, e.get('Id'), e.get('Guid')) for e in root.iter() if e.tag.split('}')[-1] in
+                      ('Component', 'File', 'Directory'))
+
+    def test_independent_of_staged_dir(self):
+        self.assertEqual(self.ids('staging'), self.ids('build'))
+
+    def test_depends_on_install_location(self):
+        self.assertNotEqual(self.ids('staging'), self.ids('staging', installdir='Other'))
+
+class Wix3Tests(unittest.TestCase):
+
+    def convert(self, **kwargs):
+        inventory = {'staging': createmsi.tree_from_paths('staging', [('bin/prog.exe', None), ('readme.txt', None)])}
+        p = createmsi.PackageGenerator(definition(**kwargs), basedir='.', inventory=inventory)
+        return createmsi.wix4_to_wix3(ET.fromstring(p.generate_wxs()))
+
+    def test_product(self):
+        root = self.convert(product_guid='D1F3D6C7-D740-46DD-8B3B-1902FD303D34')
+        self.assertEqual(root.tag, 'Wix')
+        self.assertEqual(root.get('xmlns'), createmsi.WIX3_NAMESPACE)
+        product = root.find('Product')
+        self.assertEqual(product.get('Id'), 'D1F3D6C7-D740-46DD-8B3B-1902FD303D34')
+        package = product[0]
+        self.assertEqual(package.tag, 'Package')
+        self.assertEqual(package.get('Manufacturer'), 'Test')
+        self.assertIsNone(product.find('SummaryInformation'))
+        self.assertFalse([e for e in root.iter() if e.tag in createmsi.WIX_UI_ELEMENTS])
+
+    def test_directories(self):
+        product = self.convert().find('Product')
+        self.assertIsNone(product.find('StandardDirectory'))
+        targetdir = product.find('Directory')
+        self.assertEqual(targetdir.get('Id'), 'TARGETDIR')
+        names = [d.get('Name') for d in targetdir.iter('Directory')]
+        self.assertIn('Test', names)
+        self.assertIn('bin', names)
+
+    def test_absent(self):
+        d = definition()
+        d['parts'][0]['absent'] = 'disallow'
+        product = self.convert(parts=d['parts']).find('Product')
+        features = [f for f in product.iter('Feature') if f.get('Id') == 'Core']
+        self.assertEqual(features[0].get('Absent'), 'disallow')
+        self.assertIsNone(features[0].get('AllowAbsent'))
+
+if __name__ == '__main__':
+    unittest.main()